@@ -0,0 +1,274 @@
+"""Counters and latency histograms of the sharing operations.
+
+Disabled by default, an instrumented call then only checks a flag.
+Enabled with sinks, e.g.:
+
+    from core import metrics
+    mem = metrics.MemorySink()
+    metrics.enable(mem, metrics.PrometheusSink("/tmp/ccdsuc.prom"),
+                   flush_interval=10)
+    ...
+    metrics.flush()
+    print(mem.snapshot)
+
+Names are dotted, e.g. "sharing.share_files" (a histogram of seconds),
+"bytes.storage.upload_table", "errors.storage.upload_table" and
+"cache.tables.hit" (counters).
+"""
+
+import os
+import json
+import time
+import threading
+import contextvars
+from bisect import bisect_left
+
+# upper bounds in seconds, the last bucket is +Inf
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Counts of observations per bucket, not cumulative"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return { "buckets": list(self.buckets), "counts": list(self.counts),
+                 "count": self.count, "sum": self.sum }
+
+class Sink:
+    """Where metrics go. event() is called on every observation while
+    enabled, so it should be cheap, flush() with a snapshot from
+    Metrics.snapshot()"""
+
+    def event(self, kind, name, value):
+        pass
+
+    def flush(self, snapshot):
+        pass
+
+    def close(self):
+        pass
+
+class MemorySink(Sink):
+    """Keeps the last flushed snapshot"""
+
+    def __init__(self):
+        self.snapshot = None
+
+    def flush(self, snapshot):
+        self.snapshot = snapshot
+
+class PrometheusSink(Sink):
+    """Writes the Prometheus text format to a file on every flush,
+    e.g. for node_exporter's textfile collector"""
+
+    def __init__(self, path, prefix="ccdsuc"):
+        self.path = path
+        self.prefix = prefix
+
+    def metric_name(self, name):
+        return f"{self.prefix}_{name}".replace(".", "_").replace("-", "_")
+
+    def render(self, snapshot):
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            name = self.metric_name(name) + "_total"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+        for name, h in sorted(snapshot["histograms"].items()):
+            name = self.metric_name(name) + "_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            total = 0
+            for le, count in zip(h["buckets"] + ["+Inf"], h["counts"]):
+                total += count
+                lines.append(f'{name}_bucket{{le="{le}"}} {total}')
+            lines.append(f"{name}_sum {h['sum']}")
+            lines.append(f"{name}_count {h['count']}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self, snapshot):
+        # readers never see a partially written file
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render(snapshot))
+        os.replace(tmp, self.path)
+
+class JsonLinesSink(Sink):
+    """A trace, one json object per observation and per flush"""
+
+    def __init__(self, path):
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def event(self, kind, name, value):
+        self.write({ "t": time.time(), "kind": kind,
+                     "name": name, "value": value })
+
+    def flush(self, snapshot):
+        self.write({ "t": time.time(), "kind": "snapshot",
+                     "value": snapshot })
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class Metrics:
+    """Thread safe registry of counters and histograms"""
+
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.flusher = None
+        self.stopping = threading.Event()
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        for sink in self.sinks:
+            sink.event("counter", name, n)
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            h.observe(seconds)
+        for sink in self.sinks:
+            sink.event("histogram", name, seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return { "time": time.time(),
+                     "counters": dict(self.counters),
+                     "histograms": { name: h.to_dict() for name, h
+                                     in self.histograms.items() } }
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def flush(self):
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.flush(snapshot)
+        return snapshot
+
+    def enable(self, *sinks, flush_interval=None):
+        self.sinks = list(sinks)
+        self.enabled = True
+        if flush_interval is not None and self.flusher is None:
+            self.stopping.clear()
+            self.flusher = threading.Thread(
+                target=self.flush_every, args=(flush_interval,), daemon=True)
+            self.flusher.start()
+
+    # flushes the sinks for the last time
+    def disable(self):
+        self.enabled = False
+        if self.flusher is not None:
+            self.stopping.set()
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+
+    def flush_every(self, interval):
+        while not self.stopping.wait(interval):
+            self.flush()
+
+# the registry of this process
+METRICS = Metrics()
+
+def enable(*sinks, flush_interval=None):
+    METRICS.enable(*sinks, flush_interval=flush_interval)
+
+def disable():
+    METRICS.disable()
+
+def flush():
+    return METRICS.flush()
+
+def snapshot():
+    return METRICS.snapshot()
+
+def count(name, n=1):
+    METRICS.count(name, n)
+
+# counts "cache.<name>.hit" or "cache.<name>.miss"
+def cache_lookup(name, hit):
+    if METRICS.enabled:
+        METRICS.count(f"cache.{name}.{'hit' if hit else 'miss'}")
+
+# names of the timed calls running in this thread or task,
+# so wrappers calling their super() are only counted once
+RUNNING = contextvars.ContextVar("running_timed", default=())
+
+def timed(name, nbytes=None):
+    """Decorates a function to observe its latency, count its errors
+    and, with nbytes(args, ret), the bytes it moved"""
+    registry = METRICS
+
+    def record(start, args, ret):
+        registry.observe(name, time.perf_counter() - start)
+        if nbytes is not None:
+            n = nbytes(args, ret)
+            if n:
+                registry.count(f"bytes.{name}", n)
+
+    def decorator(fn):
+        def timed_fn(*args, **kwargs):
+            if not registry.enabled:
+                return fn(*args, **kwargs)
+            running = RUNNING.get()
+            if name in running:
+                return fn(*args, **kwargs)
+            token = RUNNING.set(running + (name,))
+            start = time.perf_counter()
+            try:
+                ret = fn(*args, **kwargs)
+            except Exception:
+                registry.count(f"errors.{name}")
+                raise
+            finally:
+                RUNNING.reset(token)
+            record(start, args, ret)
+            return ret
+        timed_fn.__name__ = fn.__name__
+        timed_fn.__doc__ = fn.__doc__
+        return timed_fn
+    return decorator
+
+# nbytes of timed(), length of a positional argument or of the result
+def arg_len(i):
+    return lambda args, ret: len(args[i]) if len(args) > i and \
+        isinstance(args[i], (bytes, bytearray, memoryview)) else 0
+
+def ret_len(args, ret):
+    return len(ret) if isinstance(ret, (bytes, bytearray)) else 0
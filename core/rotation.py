@@ -0,0 +1,171 @@
+"""Background re-encryption of files with new IVs (i.e. new keys)"""
+
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from core.sharing       import REENCRYPT_THROTTLE, REENCRYPT_WORKERS
+
+class Throttle:
+    """Limits the rate of bytes going through it, callers reserve their
+    bytes and sleep until their turn. A rate of None means no limit"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def consume(self, nbytes):
+        if not self.rate or not nbytes:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next, now)
+            self.next = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+class RotationWorker:
+    """Re-encrypts a set of files with new IVs and updates the tables of
+    the users who have them shared with.
+
+    Files are re-encrypted by a bounded workers pool in batches, the
+    tables are rewritten once per batch. Each worker re-encrypts the
+    segments of its file itself, so max_workers threads re-encrypt. The bytes per second read from
+    the storage are throttled per re-encrypted segment, so a large
+    rotation does not starve the other users of the storage (e.g. FUSE
+    reads), even while re-encrypting one large file.
+
+    With a checkpoint file, the rotated files are recorded after every
+    batch and a new worker with the same checkpoint (and files=None)
+    continues from where the last one stopped. A file re-encrypted in
+    an interrupted batch, or that failed, is just re-encrypted again.
+
+    su:            the SharingUtility of the owner of the files
+    files:         files to re-encrypt, None to take them from checkpoint
+    k_pub_getter:  function(user_id) returns public key
+    max_workers:   size of the workers pool
+    bytes_per_sec: throttle, None for no limit
+    batch_size:    files re-encrypted between tables updates
+    checkpoint:    path of a json file to resume from
+    on_progress:   function(done, total, done_bytes) called after every file
+    """
+
+    def __init__(self, su, files, k_pub_getter, max_workers=2,
+                 bytes_per_sec=None, batch_size=32, checkpoint=None,
+                 on_progress=None):
+        if k_pub_getter is None:
+            raise Exception("Public keys are needed to rotate files")
+        self.su = su
+        self.k_pub_getter = k_pub_getter
+        self.max_workers = max_workers
+        self.throttle = Throttle(bytes_per_sec)
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.on_progress = on_progress
+
+        done = []
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with open(checkpoint, "r") as f:
+                state = json.load(f)
+            if files is None:
+                files = state["files"]
+            done = state["done"]
+        if files is None:
+            files = []
+
+        self.files = []
+        for f in files:
+            f = su.access_wrapper.name(f)
+            if f not in self.files:
+                self.files.append(f)
+        # files processed, and the ones with their tables updated,
+        # i.e. saved in the checkpoint
+        self.done = [f for f in done if f in self.files]
+        self.saved = list(self.done)
+        self.failed = []
+        self.done_bytes = 0
+
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    # running
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    # stop after the current batch, can be resumed from the checkpoint
+    def stop(self):
+        self.stopping.set()
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def is_done(self):
+        return len(self.saved) == len(self.files)
+
+    # returns True if every file was re-encrypted successfully
+    def run(self):
+        todo = [f for f in self.files if f not in self.done]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for i in range(0, len(todo), self.batch_size):
+                if self.stopping.is_set():
+                    break
+                batch = todo[i:i + self.batch_size]
+                results = list(pool.map(self.rotate, batch))
+                rotated = [f for f, ok in zip(batch, results) if ok]
+                self.update_tables(rotated)
+                # failed files are left for the next run
+                with self.lock:
+                    self.saved += rotated
+                self.save_checkpoint()
+        return self.is_done() and len(self.failed) == 0
+
+    def rotate(self, file_name):
+        size = self.su.access_wrapper.file_size(file_name)
+        token = REENCRYPT_THROTTLE.set(self.throttle.consume)
+        workers = REENCRYPT_WORKERS.set(1)
+        try:
+            ok = self.su.access_wrapper.reupload_file(self.su, file_name)
+        except Exception:
+            ok = False
+        finally:
+            REENCRYPT_WORKERS.reset(workers)
+            REENCRYPT_THROTTLE.reset(token)
+        with self.lock:
+            self.done.append(file_name)
+            if not ok:
+                self.failed.append(file_name)
+            elif size is not None:
+                self.done_bytes += size
+        if self.on_progress is not None:
+            self.on_progress(*self.progress())
+        return ok
+
+    def update_tables(self, files):
+        if len(files) == 0:
+            return
+        # retried on conflicts with other writers of the tables
+        self.su.rotate_files(files, self.k_pub_getter, reupload=False)
+        # lazily revoked files are done too
+        self.su.drop_pending(files)
+
+    # (files done, total files, bytes re-encrypted)
+    def progress(self):
+        with self.lock:
+            return len(self.done), len(self.files), self.done_bytes
+
+    def save_checkpoint(self):
+        if self.checkpoint is None:
+            return
+        with self.lock:
+            state = { "files": self.files, "done": self.saved }
+        tmp = f"{self.checkpoint}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint)
@@ -1,21 +1,34 @@
 """The implementation of the secure key sharing"""
 
 import random
+import os
 import hashlib
 import secrets
 import base64
 import pickle
 import json
 import time
+import struct
+import threading
+import asyncio
+import contextvars
+import functools
+from collections         import OrderedDict, deque
+from itertools           import accumulate
+from concurrent.futures  import ThreadPoolExecutor
 from Crypto              import Random
 from Crypto.Cipher       import AES, PKCS1_OAEP
 from Crypto.PublicKey    import RSA, ECC
 from Crypto.Util         import Counter
 from Crypto.Util.Padding import pad, unpad
-
-# set the public key type, RSA or ECC
-# stick to RSA for now as ECC is not yet supported
-# in pycryptodome.
+from Crypto.Hash         import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Protocol.DH  import key_agreement
+from core.metrics        import METRICS, timed, arg_len, ret_len, cache_lookup
+
+# set the public key type, RSA or ECC (X25519)
+# both can be used together, tables are encrypted
+# according to the key of the recipient.
 PublicKey = RSA
 
 # follow AES block size
@@ -47,33 +60,122 @@ def gen_keys_from(passphrase):
     if PublicKey == RSA:
         k_priv = PublicKey.generate(bits=2048, randfunc=my_rand)
     elif PublicKey == ECC:
-        k_priv = PublicKey.generate(curve="P-256", randfunc=my_rand)
+        k_priv = PublicKey.generate(curve="Curve25519", randfunc=my_rand)
     else:
         raise Exception("Unknown public key type")
     k_pub = k_priv.public_key()
 
     return { "sym": k_sym, "priv": k_priv, "pub": k_pub }
 
+def export_key(key, fmt="PEM"):
+    key = key.export_key(format=fmt)
+    return key.encode() if isinstance(key, str) else key
+
+# import a public or private key of any type, RSA or ECC
+def import_key(key):
+    for key_type in [PublicKey, RSA, ECC]:
+        try:
+            return key_type.import_key(key)
+        except ValueError:
+            pass
+    raise ValueError("Unknown public key format")
+
 def stringify_keys(keys):
     return {
         "sym":  base64.b64encode(keys["sym"]).decode(),
-        "priv": keys["priv"].export_key('PEM').decode(),
-        "pub":  keys["pub"].export_key('PEM').decode()
+        "priv": export_key(keys["priv"]).decode(),
+        "pub":  export_key(keys["pub"]).decode()
     }
 
 def unstringify_keys(str_keys):
     return {
         "sym":  base64.b64decode(str_keys["sym"].encode()),
-        "priv": PublicKey.import_key(str_keys["priv"]),
-        "pub":  PublicKey.import_key(str_keys["pub"])
+        "priv": import_key(str_keys["priv"]),
+        "pub":  import_key(str_keys["pub"])
     }
 
+# keys cache
+
+# binary keys cache format:
+# +-------+-----------------+-----+-----+------+-----+------+-----+
+# | magic | passphrase hash | len | sym | len  | priv| len  | pub |
+# +-------+-----------------+-----+-----+------+-----+------+-----+
+#    5           32            4    ...    4     DER    4     DER
+KEYS_CACHE_MAGIC = b"CCDK\x01"
+
+def passphrase_hash(passphrase):
+    if passphrase is None:
+        return bytes(32)
+    return hashlib.sha256(b"ccdsuc-keys-cache" + passphrase.encode()).digest()
+
+class LazyKeys(dict):
+    """Keys dict that imports the public and private keys
+    from DER only when they are first used"""
+
+    def __init__(self, sym, priv_der, pub_der):
+        super().__init__(sym=sym)
+        self.der = { "priv": priv_der, "pub": pub_der }
+
+    def __getitem__(self, k):
+        if not dict.__contains__(self, k) and k in self.der:
+            dict.__setitem__(self, k, import_key(self.der[k]))
+        return dict.__getitem__(self, k)
+
+    def __contains__(self, k):
+        return dict.__contains__(self, k) or k in self.der
+
+def pack_keys(keys, passphrase=None):
+    fields = [keys["sym"],
+              export_key(keys["priv"], "DER"),
+              export_key(keys["pub"], "DER")]
+    out = [KEYS_CACHE_MAGIC, passphrase_hash(passphrase)]
+    for field in fields:
+        out.append(len(field).to_bytes(4, "big"))
+        out.append(field)
+    return b"".join(out)
+
+def unpack_keys(data, passphrase=None):
+    """Returns the keys packed with pack_keys(), or None if the data is
+    not a keys cache or was made from another passphrase"""
+    m = len(KEYS_CACHE_MAGIC)
+    if data[:m] != KEYS_CACHE_MAGIC:
+        return None
+    if passphrase is not None and data[m:m + 32] != passphrase_hash(passphrase):
+        return None
+    data = memoryview(data)
+    fields = []
+    i = m + 32
+    for _ in range(3):
+        size = int.from_bytes(data[i:i + 4], "big")
+        fields.append(bytes(data[i + 4:i + 4 + size]))
+        i += 4 + size
+    return LazyKeys(*fields)
+
+def load_keys_cache(path, passphrase=None):
+    """Loads keys from a cache file, either binary or the old json"""
+    with open(path, "rb") as f:
+        data = f.read()
+    keys = unpack_keys(data, passphrase)
+    if keys is None and not data.startswith(KEYS_CACHE_MAGIC):
+        # old json cache
+        keys = unstringify_keys(json.loads(data))
+        if passphrase is not None and \
+           keys["sym"] != hashlib.sha256(passphrase.encode()).digest():
+            return None
+    return keys
+
+def save_keys_cache(path, keys, passphrase=None):
+    with open(path, "wb") as f:
+        f.write(pack_keys(keys, passphrase))
+
 # tiny cyphers
 
-def ctr_from_iv(iv):
+# block i of a file is encrypted with the counter iv + i
+def ctr_from_iv(iv, first_block=0):
     iv = int.from_bytes(iv, "big") if iv is not None else 0
-    return Counter.new(8 * AES.block_size, initial_value=iv)
+    return Counter.new(8 * AES.block_size, initial_value=iv + first_block)
 
+@timed("crypto.sym_enc", arg_len(0))
 def sym_enc(data, key, iv=None):
     if iv is None:
         iv = Random.new().read(AES.block_size)
@@ -81,44 +183,326 @@ def sym_enc(data, key, iv=None):
     ciphertext = cipher.encrypt(pad(data, AES.block_size))
     return iv + ciphertext
 
+@timed("crypto.sym_dec", arg_len(0))
 def sym_dec(data, key):
     iv = data[:AES.block_size]
-    ciphertext = data[AES.block_size:]
+    ciphertext = memoryview(data)[AES.block_size:]
     cipher = AES.new(key, AES.MODE_CTR, counter=ctr_from_iv(iv))
     return unpad(cipher.decrypt(ciphertext), AES.block_size)
 
-def asym_enc(data, key):
-    session_key = secrets.token_bytes(nbytes=int(AES.key_size[-1]))
+# streaming cyphers, same format as sym_enc() and sym_dec() but
+# processed in chunks, so large files are never fully in memory.
+# sources can be bytes, file objects, or iterators of bytes
+
+SYM_CHUNK_SIZE = 64 * 1024
+
+def read_chunks(src, chunk_size=SYM_CHUNK_SIZE):
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        src = memoryview(src)
+        for i in range(0, len(src), chunk_size):
+            yield src[i:i + chunk_size]
+    elif hasattr(src, "read"):
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        yield from src
 
-    # Encrypt the session key with the public key
-    cipher_pub = PKCS1_OAEP.new(key)
-    session_key_enc = cipher_pub.encrypt(session_key)
+def sym_enc_stream(src, key, iv=None, chunk_size=SYM_CHUNK_SIZE):
+    """Yields the iv then the encrypted chunks of src"""
+    if iv is None:
+        iv = Random.new().read(AES.block_size)
+    cipher = AES.new(key, AES.MODE_CTR, counter=ctr_from_iv(iv))
+    yield iv
+    size = 0
+    for chunk in read_chunks(src, chunk_size):
+        size += len(chunk)
+        yield cipher.encrypt(chunk)
+    # CTR does not need it, but the format is padded
+    padding = AES.block_size - size % AES.block_size
+    yield cipher.encrypt(bytes([padding]) * padding)
+
+def sym_dec_stream(src, key, chunk_size=SYM_CHUNK_SIZE):
+    """Yields the decrypted chunks of src, the last block
+    is held back until the padding is checked"""
+    chunks = read_chunks(src, chunk_size)
+    iv = b""
+    for chunk in chunks:
+        iv += bytes(chunk)
+        if len(iv) >= AES.block_size:
+            break
+    iv, rest = iv[:AES.block_size], iv[AES.block_size:]
+    if len(iv) != AES.block_size:
+        raise ValueError("Data is too short")
+    cipher = AES.new(key, AES.MODE_CTR, counter=ctr_from_iv(iv))
+
+    size = 0
+    tail = cipher.decrypt(rest)
+    for chunk in chunks:
+        size += len(chunk)
+        chunk = tail + cipher.decrypt(chunk)
+        tail = chunk[-AES.block_size:]
+        if len(chunk) > AES.block_size:
+            yield chunk[:-AES.block_size]
+    size += len(rest)
+
+    if size == 0 or size % AES.block_size != 0:
+        raise ValueError("Input data is not padded")
+    padding = tail[-1]
+    if padding < 1 or padding > AES.block_size or \
+       tail[-padding:] != bytes([padding]) * padding:
+        raise ValueError("Padding is incorrect.")
+    if len(tail) > padding:
+        yield tail[:len(tail) - padding]
+
+# re-encryption
+#
+# CTR is seekable, so a ciphertext can be moved from (k, iv) to
+# (k', iv') in independent segments without unpadding it:
+#   c'_i = c_i ^ E(k, iv + i) ^ E(k', iv' + i)
+# the padding is re-encrypted along with the data, so this works for
+# sym_enc() files as well as CryptoFS ones, given the ciphertext only
+
+REENCRYPT_SEGMENT_SIZE = 1024 * 1024
+
+# function(nbytes) called with every segment read by the re-encryptions
+# of the running thread or task, e.g. to throttle them (see core.rotation)
+REENCRYPT_THROTTLE = contextvars.ContextVar("reencrypt_throttle",
+                                            default=None)
+
+# threads re-encrypting the segments of a stream for the running thread
+# or task, None for one per CPU. With 1, the segments are re-encrypted
+# by the caller's thread, e.g. a worker of a bounded pool (core.rotation)
+REENCRYPT_WORKERS = contextvars.ContextVar("reencrypt_workers",
+                                           default=None)
+
+@timed("crypto.ctr_reencrypt", arg_len(0))
+def ctr_reencrypt(data, old_key, old_iv, new_key, new_iv, offset=0):
+    """Re-encrypts a segment of a ciphertext starting at offset"""
+    first_block, skip = divmod(offset, AES.block_size)
+    old = AES.new(old_key, AES.MODE_CTR,
+                  counter=ctr_from_iv(old_iv, first_block))
+    new = AES.new(new_key, AES.MODE_CTR,
+                  counter=ctr_from_iv(new_iv, first_block))
+    if skip:
+        # move both keystreams to the middle of the block
+        old.decrypt(bytes(skip))
+        new.encrypt(bytes(skip))
+    out = bytearray(len(data))
+    old.decrypt(data, output=out)
+    new.encrypt(out, output=out)
+    return out
+
+def ctr_reencrypt_stream(src, old_key, old_iv, new_key, new_iv,
+                         segment_size=REENCRYPT_SEGMENT_SIZE,
+                         max_workers=None):
+    """Yields the segments of the ciphertext src re-encrypted in order.
+    Segments are re-encrypted concurrently by a threads pool (AES
+    releases the GIL), at most 2 segments per worker are in memory"""
+    if max_workers is None:
+        max_workers = REENCRYPT_WORKERS.get() or os.cpu_count() or 1
+    throttle = REENCRYPT_THROTTLE.get()
+    if max_workers == 1:
+        offset = 0
+        for chunk in read_chunks(src, segment_size):
+            if throttle is not None:
+                throttle(len(chunk))
+            yield ctr_reencrypt(chunk, old_key, old_iv, new_key, new_iv,
+                                offset)
+            offset += len(chunk)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        offset = 0
+        for chunk in read_chunks(src, segment_size):
+            if throttle is not None:
+                throttle(len(chunk))
+            pending.append(pool.submit(ctr_reencrypt, chunk, old_key,
+                                       old_iv, new_key, new_iv, offset))
+            offset += len(chunk)
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# public key encryption
+#
+# the data is encrypted with an AES session key, the session key is
+# either wrapped with RSA-OAEP or derived from an ephemeral X25519
+# key agreement (ECIES). Envelopes describe their mode:
+# +-------+------+---------------------------+--------------------+
+# | magic | mode | wrapped key / ephemeral   | iv + ciphertext    |
+# +-------+------+---------------------------+--------------------+
+#    3       1     RSA size (256) / 32 bytes
+# envelopes without the header are the old RSA-2048 ones.
+
+ASYM_MAGIC = b"CE\x01"
+
+class LRUCache:
+    """Bounded thread safe least recently used cache"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, k):
+        with self.lock:
+            if k not in self.items:
+                return None
+            self.items.move_to_end(k)
+            return self.items[k]
+
+    def put(self, k, v):
+        with self.lock:
+            self.items[k] = v
+            self.items.move_to_end(k)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+# unwrapped session keys, (key, H(wrapped session key)) -> session key.
+# the same tables are decrypted again and again, this saves
+# the private key operation when they did not change
+session_keys_cache = LRUCache(1024)
+
+class RSABackend:
+    mode = b"R"
+
+    def __init__(self):
+        # prepared ciphers, one per key
+        self.ciphers = LRUCache(64)
+
+    def handles(self, key):
+        return isinstance(key, RSA.RsaKey)
+
+    def header_size(self, key):
+        return key.size_in_bytes()
+
+    def cipher(self, key):
+        # keys are kept with the ciphers so that id(key) is not reused
+        cached = self.ciphers.get(id(key))
+        if cached is not None and cached[0] is key:
+            return cached[1]
+        cipher = PKCS1_OAEP.new(key)
+        self.ciphers.put(id(key), (key, cipher))
+        return cipher
+
+    @timed("crypto.rsa_wrap")
+    def new_session(self, key):
+        session_key = secrets.token_bytes(nbytes=int(AES.key_size[-1]))
+        # Encrypt the session key with the public key
+        return session_key, self.cipher(key).encrypt(session_key)
+
+    @timed("crypto.rsa_unwrap")
+    def open_session(self, header, key):
+        # Decrypt the session key
+        return self.cipher(key).decrypt(header)
+
+class X25519Backend:
+    mode = b"X"
+
+    def handles(self, key):
+        return isinstance(key, ECC.EccKey) and key.curve == "Curve25519"
+
+    def header_size(self, key):
+        return 32
+
+    def kdf(self, eph_pub, key_pub):
+        return lambda z: HKDF(z + eph_pub + key_pub, AES.key_size[-1],
+                              b"", SHA256, context=b"ccdsuc-ecies")
+
+    @timed("crypto.x25519_wrap")
+    def new_session(self, key):
+        eph = ECC.generate(curve="Curve25519")
+        eph_pub = eph.public_key().export_key(format="raw")
+        key_pub = key.public_key().export_key(format="raw")
+        session_key = key_agreement(static_pub=key, eph_priv=eph,
+                                    kdf=self.kdf(eph_pub, key_pub))
+        return session_key, eph_pub
+
+    @timed("crypto.x25519_unwrap")
+    def open_session(self, header, key):
+        eph = ECC.construct(curve="Curve25519",
+                            point_x=int.from_bytes(header, "little"))
+        key_pub = key.public_key().export_key(format="raw")
+        return key_agreement(static_priv=key, eph_pub=eph,
+                             kdf=self.kdf(bytes(header), key_pub))
+
+asym_backends = [RSABackend(), X25519Backend()]
+
+def asym_backend(key=None, mode=None):
+    for backend in asym_backends:
+        if (mode is not None and backend.mode == mode) or \
+           (mode is None and backend.handles(key)):
+            return backend
+    if mode is not None:
+        raise ValueError(f"Unknown envelope mode {mode!r}")
+    raise ValueError("Unknown public key type")
+
+@timed("crypto.asym_enc", arg_len(0))
+def asym_enc(data, key):
+    backend = asym_backend(key)
+    session_key, header = backend.new_session(key)
 
     # Encrypt the data with the AES session key
     ciphertext = sym_enc(data, session_key)
-    return session_key_enc + ciphertext
+    return ASYM_MAGIC + backend.mode + header + ciphertext
 
 def asym_enc_v(data, key):
-    session_key = secrets.token_bytes(nbytes=int(AES.key_size[-1]))
+    backend = asym_backend(key)
+    session_key, header = backend.new_session(key)
     print(f"++ session_key: {len(session_key)}")
-
-    # Encrypt the session key with the public key
-    cipher_pub = PKCS1_OAEP.new(key)
-    session_key_enc = cipher_pub.encrypt(session_key)
-    print(f"++ session_key_enc: {len(session_key_enc)}")
+    print(f"++ session_key_enc: {len(header)} ({backend.mode.decode()})")
 
     # Encrypt the data with the AES session key
     ciphertext = sym_enc(data, session_key)
     print(f"++ plaintext: {len(data)}, ciphertext: {len(ciphertext)}")
-    return session_key_enc + ciphertext
-
+    return ASYM_MAGIC + backend.mode + header + ciphertext
+
+# open the session with the cache of unwrapped session keys
+def open_session(backend, header, key):
+    k = (id(key), backend.mode, hashlib.sha256(header).digest())
+    cached = session_keys_cache.get(k)
+    hit = cached is not None and cached[0] is key
+    cache_lookup("session_keys", hit)
+    if hit:
+        return cached[1]
+    session_key = backend.open_session(header, key)
+    session_keys_cache.put(k, (key, session_key))
+    return session_key
+
+@timed("crypto.asym_dec", arg_len(0))
 def asym_dec(data, key):
+    m = len(ASYM_MAGIC)
+    if data[:m] == ASYM_MAGIC:
+        try:
+            backend = asym_backend(mode=data[m:m + 1])
+            if backend.handles(key):
+                size = backend.header_size(key)
+                header = data[m + 1:m + 1 + size]
+                session_key = open_session(backend, header, key)
+                # Decrypt the data
+                return sym_dec(data[m + 1 + size:], session_key)
+        except ValueError:
+            # most likely an old envelope that happens to
+            # start with the magic
+            pass
+
+    # old RSA envelope, no header
+    if not asym_backend(mode=RSABackend.mode).handles(key):
+        raise ValueError("Unknown envelope")
     session_key_enc = data[:AES.key_size[-1] * 8]
     ciphertext = data[AES.key_size[-1] * 8:]
 
     # Decrypt the session key
-    cipher_pub = PKCS1_OAEP.new(key)
-    session_key = cipher_pub.decrypt(session_key_enc)
+    session_key = open_session(asym_backend(mode=RSABackend.mode),
+                               session_key_enc, key)
 
     # Decrypt the data
     return sym_dec(ciphertext, session_key)
@@ -156,8 +540,430 @@ def picklize(o):
 def unpicklize(b):
     return pickle.loads(b)
 
+# binary
+#
+# compact column based encoding of the shapes of tables:
+# T_A,B      { "f" -> "k_f", ... }  (file -> fixed width key)
+# +-------+-------+-------+-------+--------------+-------+------+
+# | magic | shape | width | count | paths sizes  | paths | keys |
+# +-------+-------+-------+-------+--------------+-------+------+
+#    3        1       1       4     2 * count
+# a path size with the highest bit set means an empty key
+# T_A,others { "B" -> ["f", ...], ... }  (user -> files list)
+# +-------+-------+-------+-------------+-------------+-------------+-------+-------+
+# | magic | shape | count | users sizes | files count | paths sizes | users | paths |
+# +-------+-------+-------+-------------+-------------+-------------+-------+-------+
+#    3        1       4     2 * count     4 * count     2 * files
+# blobs      { "t" -> b"...", ... }  (name -> bytes, e.g. tables)
+# +-------+-------+-------+-------------+--------------+-------+--------+
+# | magic | shape | count | names sizes | values sizes | names | values |
+# +-------+-------+-------+-------------+--------------+-------+--------+
+#    3        1       4     2 * count     4 * count
+# anything else is pickled after the magic and shape (0).
+# decoding reads the buffer in place (bytes or memoryview), the
+# strings and keys are the only copies
+
+BINARY_MAGIC = b"CB\x01"
+BINARY_PICKLE = 0
+BINARY_KEYS   = 1
+BINARY_LISTS  = 2
+BINARY_BLOBS  = 3
+BINARY_EMPTY  = 0x8000
+
+def is_binary(b):
+    return b[:len(BINARY_MAGIC)] == BINARY_MAGIC
+
+def binary_shape(o):
+    if not isinstance(o, dict) or \
+       not all(isinstance(k, str) for k in o):
+        return BINARY_PICKLE, 0
+    values = list(o.values())
+    if all(isinstance(v, bytes) for v in values):
+        widths = set(len(v) for v in values if len(v) > 0)
+        if len(widths) <= 1 and max(widths, default=0) < 256:
+            return BINARY_KEYS, max(widths, default=0)
+        return BINARY_BLOBS, 0
+    elif all(isinstance(v, list) and
+             all(isinstance(f, str) for f in v) for v in values):
+        return BINARY_LISTS, 0
+    return BINARY_PICKLE, 0
+
+def pack_sizes(fmt, sizes):
+    return struct.pack(f">{len(sizes)}{fmt}", *sizes)
+
+def unpack_strings(b, i, sizes):
+    """Decodes consecutive utf-8 strings starting at i,
+    returns the strings and the position after them"""
+    ends = list(accumulate(sizes, initial=0))
+    blob = str(b[i:i + ends[-1]], "utf-8")
+    if blob.isascii():
+        # decoded once, offsets in bytes are offsets in characters
+        strings = [blob[s:e] for s, e in zip(ends, ends[1:])]
+    else:
+        strings = [str(b[i + s:i + e], "utf-8")
+                   for s, e in zip(ends, ends[1:])]
+    return strings, i + ends[-1]
+
+def binarize(o):
+    shape, width = binary_shape(o)
+    if shape == BINARY_PICKLE:
+        return BINARY_MAGIC + bytes([shape]) + pickle.dumps(o)
+    out = [BINARY_MAGIC, bytes([shape])]
+    if shape == BINARY_KEYS:
+        paths = [k.encode() for k in o]
+        sizes = [len(p) | (BINARY_EMPTY if len(o[k]) == 0 else 0)
+                 for p, k in zip(paths, o)]
+        out += [struct.pack(">BI", width, len(o)), pack_sizes("H", sizes)]
+        out += paths
+        out += o.values()
+    elif shape == BINARY_BLOBS:
+        names = [k.encode() for k in o]
+        out += [struct.pack(">I", len(o)),
+                pack_sizes("H", [len(n) for n in names]),
+                pack_sizes("I", [len(v) for v in o.values()])]
+        out += names
+        out += o.values()
+    else:
+        users = [k.encode() for k in o]
+        paths = [f.encode() for k in o for f in o[k]]
+        out += [struct.pack(">I", len(o)),
+                pack_sizes("H", [len(u) for u in users]),
+                pack_sizes("I", [len(o[k]) for k in o]),
+                pack_sizes("H", [len(p) for p in paths])]
+        out += users
+        out += paths
+    return b"".join(out)
+
+# allow_pickle: False for data that may come from others unencrypted
+def unbinarize(b, allow_pickle=True):
+    i = len(BINARY_MAGIC)
+    shape = b[i]
+    i += 1
+    if shape == BINARY_PICKLE:
+        if not allow_pickle:
+            raise ValueError("Pickled binary table")
+        return pickle.loads(b[i:])
+    if shape == BINARY_KEYS:
+        width, count = struct.unpack_from(">BI", b, i)
+        i += 5
+        sizes = struct.unpack_from(f">{count}H", b, i)
+        i += 2 * count
+        if count == 0:
+            return {}
+        if not any(s & BINARY_EMPTY for s in sizes):
+            paths, i = unpack_strings(b, i, sizes)
+            keys = struct.unpack_from(f"{width}s" * count, b, i)
+            return dict(zip(paths, keys))
+        paths, i = unpack_strings(b, i, [s & ~BINARY_EMPTY for s in sizes])
+        keys = []
+        for s in sizes:
+            if s & BINARY_EMPTY:
+                keys.append(b"")
+            else:
+                keys.append(bytes(b[i:i + width]))
+                i += width
+        return dict(zip(paths, keys))
+    if shape == BINARY_BLOBS:
+        count, = struct.unpack_from(">I", b, i)
+        i += 4
+        names_sizes = struct.unpack_from(f">{count}H", b, i)
+        i += 2 * count
+        values_sizes = struct.unpack_from(f">{count}I", b, i)
+        i += 4 * count
+        names, i = unpack_strings(b, i, names_sizes)
+        ends = list(accumulate(values_sizes, initial=i))
+        return {name: bytes(b[s:e])
+                for name, s, e in zip(names, ends, ends[1:])}
+    if shape == BINARY_LISTS:
+        count, = struct.unpack_from(">I", b, i)
+        i += 4
+        users_sizes = struct.unpack_from(f">{count}H", b, i)
+        i += 2 * count
+        files_counts = struct.unpack_from(f">{count}I", b, i)
+        i += 4 * count
+        total = sum(files_counts)
+        paths_sizes = struct.unpack_from(f">{total}H", b, i)
+        i += 2 * total
+        users, i = unpack_strings(b, i, users_sizes)
+        paths, i = unpack_strings(b, i, paths_sizes)
+        ends = list(accumulate(files_counts, initial=0))
+        return {user: paths[s:e]
+                for user, s, e in zip(users, ends, ends[1:])}
+    raise ValueError(f"Unknown binary table shape {shape}")
+
+# tables log
+#
+# instead of re-uploading whole tables, tables can be kept as an
+# append-only log of encrypted records on top of a snapshot:
+# +-------+-----+----------+-----+--------+-----+--------+-----
+# | magic | len | snapshot | len | record | len | record | ...
+# +-------+-----+----------+-----+--------+-----+--------+-----
+#    5       4       ...      4      ...     4      ...
+# the snapshot is encrypted the same way as whole tables, along with
+# a symmetric log key the records are encrypted with, so readers do
+# a single asymmetric decryption per table:
+# snapshot = nonce | E(k_log | table)
+# records = E(record, k_log)
+# the writer derives k_log from k_A and the nonce (see log_key()).
+# records have the same shape as the tables, with each key prefixed
+# by "+" (add/set) or "-" (remove), e.g.:
+# T_A,others: { "+B" -> ["f", ...], "-C" -> ["g", ...] }
+# T_A,B:      { "+f" -> "k_f", "-g" -> b"" }
+
+TABLE_LOG_MAGIC = b"CCDL\x02"
+# logs without k_log, records are encrypted the same way as the snapshot
+TABLE_LOG_MAGIC_V1 = b"CCDL\x01"
+LOG_NONCE_SIZE = 16
+LOG_KEY_CONTEXT = b"table log"
+
+# after this many records, the log is compacted into a new snapshot
+TABLE_LOG_MAX_RECORDS = 64
+
+def is_table_log(blob):
+    return blob is not None and \
+        blob[:len(TABLE_LOG_MAGIC)] in (TABLE_LOG_MAGIC, TABLE_LOG_MAGIC_V1)
+
+def log_frame(data):
+    return len(data).to_bytes(4, "big") + data
+
+def log_frames(blob, start=None):
+    """Yields (end position, frame) of every frame after start"""
+    blob = memoryview(blob)
+    i = len(TABLE_LOG_MAGIC) if start is None else start
+    while i + 4 <= len(blob):
+        size = int.from_bytes(blob[i:i + 4], "big")
+        i += 4 + size
+        yield i, bytes(blob[i - size:i])
+
+def table_diff(old, new):
+    """The record that turns table old into table new"""
+    record = {}
+    for k in new:
+        if isinstance(new[k], list):
+            old_files = set(old.get(k, []))
+            new_files = set(new[k])
+            added = [f for f in new[k] if f not in old_files]
+            removed = [f for f in old.get(k, []) if f not in new_files]
+            if added or k not in old:
+                record["+" + k] = added
+            if removed:
+                record["-" + k] = removed
+        elif k not in old or old[k] != new[k]:
+            record["+" + k] = new[k]
+    for k in old:
+        if k not in new:
+            record["-" + k] = list(old[k]) if isinstance(old[k], list) else b""
+    return record
+
+def apply_table_record(table, record):
+    for k in record:
+        op, name, v = k[0], k[1:], record[k]
+        if isinstance(v, list):
+            files = table.setdefault(name, [])
+            if op == "+":
+                files += [f for f in v if f not in files]
+            else:
+                table[name] = [f for f in files if f not in v]
+        elif op == "+":
+            table[name] = v
+        else:
+            table.pop(name, None)
+    return table
+
+# optimistic concurrency
+#
+# tables are read, modified, then uploaded only if they were not
+# changed meanwhile (compare-and-swap on table_version()), otherwise
+# the whole operation is retried with fresh tables
+
+# expected_version of an upload that does not check the version,
+# None is the expected version of a table that does not exist
+ANY_VERSION = "*"
+
+TABLE_RETRIES = 10
+TABLE_RETRY_DELAY = 0.01
+
+class TableConflict(Exception):
+    """A table changed since it was read"""
+
+# versions of the tables read by the running operation, so concurrent
+# operations (threads or tasks) of one SharingUtility do not mix them,
+# id(SharingUtility) -> { name -> version }
+READ_VERSIONS = contextvars.ContextVar("read_versions", default=None)
+
+def retry_on_conflict(fn):
+    """Retries a SharingUtility operation when one of its
+    tables changed while running"""
+    def delay(attempt):
+        return random.SystemRandom().uniform(
+            0, TABLE_RETRY_DELAY * 2 ** min(attempt, 6))
+
+    @functools.wraps(fn)
+    def retrying(*args, **kwargs):
+        for attempt in range(TABLE_RETRIES):
+            token = READ_VERSIONS.set({})
+            try:
+                return fn(*args, **kwargs)
+            except TableConflict:
+                METRICS.count(f"conflicts.{fn.__name__}")
+                if attempt == TABLE_RETRIES - 1:
+                    raise
+            finally:
+                READ_VERSIONS.reset(token)
+            time.sleep(delay(attempt))
+    return retrying
+
+# expected version of a T_A_B in versions from
+# SharingUtility.shared_table_versions()
+def shared_table_version(versions, name):
+    if versions is None:
+        return ANY_VERSION
+    return versions.get(name)
+
+# tables names
+
+def parse_table_name(name):
+    """Returns (from, to) of a table named table_<from>_<to>,
+    or None if the name is not of a table"""
+    sp = name.split("_")
+    if len(sp) != 3 or sp[0] != "table":
+        return None
+    return sp[1], sp[2]
+
+# groups
+#
+# a group of Alice is shared with like a user, with one table for
+# all the members, encrypted with a group key k_G:
+# T_A,G = id(k_G) | E({ "f" -> "k_f", ... }, k_G)
+# k_G is wrapped once per member, and for Alice with k_A:
+# gkey_<alice>_<group>_<member> = E({ "key": k_G, "prev": k_G' }, k_Mpub)
+# changing the members only rotates k_G. Members see the group
+# as a sharer named "<alice>_<group>", e.g. "alice_@team"
+
+GROUP_PREFIX = "@"
+# between the owner and the group in the names of sharers,
+# user ids can't have it
+SHARER_SEPARATOR = "_"
+GROUP_KEY_ID_SIZE = 8
+
+def is_group(user_id):
+    return user_id.startswith(GROUP_PREFIX)
+
+def group_id(name):
+    return name if is_group(name) else GROUP_PREFIX + name
+
+# "_" separates the parts of the tables names
+def is_valid_group(group):
+    name = group[len(GROUP_PREFIX):] if is_group(group) else group
+    return name != "" and "_" not in name
+
+def check_group(group):
+    if not is_valid_group(group):
+        raise Exception(f"Invalid group name ({group}), it can't be empty or have '_' in it")
+
+def parse_gkey_name(name):
+    """Returns (owner, group, member) of a group key table
+    named gkey_<owner>_<group>_<member>, or None"""
+    sp = name.split("_")
+    if len(sp) != 4 or sp[0] != "gkey" or not is_group(sp[2]):
+        return None
+    return sp[1], sp[2], sp[3]
+
+def split_sharer(sharer):
+    """(owner, group) of a sharer, group is None for users"""
+    owner, sep, group = sharer.partition(SHARER_SEPARATOR)
+    if not sep:
+        return sharer, None
+    if owner == "" or is_group(owner) or not is_group(group) or \
+       not is_valid_group(group):
+        raise ValueError(f"Invalid sharer {sharer}")
+    return owner, group
+
+# the user whose files a sharer shares
+def sharer_owner(sharer):
+    return split_sharer(sharer)[0]
+
+# group tables start with the id of the key they are encrypted with,
+# members keep the previous key while the table gets re-encrypted
+def group_key_id(key):
+    return hashlib.sha256(key).digest()[:GROUP_KEY_ID_SIZE]
+
+# directory keys
+#
+# with dir_keys, files keys are derived from their paths by an HKDF
+# tree over the path components, and the epochs of the directories:
+# k_/ = HKDF(k_A), k_d/c = HKDF(k_d, c | epoch(d/c)), k_f = H(f_IV | k_path)
+# a directory is shared as one "dir/" entry of T_A_B holding k_dir,
+# the keys of all the files under it are derived from it. Revoking a
+# directory bumps its epoch, i.e. changes every key under it
+
+DIR_KEY_CONTEXT = b"dirs"
+
+def path_components(path):
+    return [c for c in path.split("/") if c]
+
+# "/a/b/", "a/b", ... -> "a/b"
+def normalize_path(path):
+    return "/".join(path_components(path))
+
+def is_dir_entry(name):
+    return name.endswith("/")
+
+# checks if a T_A_B entry (file or "dir/") gives the key of path
+def entry_covers(entry, path):
+    entry_comps = path_components(entry)
+    path_comps = path_components(path)
+    if is_dir_entry(entry):
+        return path_comps[:len(entry_comps)] == entry_comps
+    return entry_comps == path_comps
+
+# epochs: { "a/b": n, ... } of the dirs, none for the dirs under a shared
+# one (they are shared with their own entries), parent: the components
+# the key is of
+def derive_node_key(key, components, epochs=None, parent=()):
+    path = list(parent)
+    for c in components:
+        path.append(c)
+        epoch = epochs.get("/".join(path), 0) if epochs else 0
+        key = HKDF(key, AES.key_size[-1], b"", SHA256,
+                   context=f"{c}/{epoch}".encode())
+    return key
+
 class AccessWrapper(object):
     use_json = False
+    # "pickle", "json", or "binary", None follows use_json
+    codec = None
+    # False if writing different tables at the same time is not
+    # safe, e.g. all tables are stored in a single blob
+    concurrent_writes = True
+
+    # storage operations counted and timed as "storage.<name>", in
+    # every wrapper, see core.metrics. name -> bytes moved
+    metered = {
+        "list_tables": None,
+        "load_table": ret_len,
+        "table_version": None,
+        "upload_table": arg_len(2),
+        "append_table": arg_len(2),
+        "delete_table": None,
+        "load_file_iv": None,
+        "file_exists": None,
+        "dir_files": None,
+        "file_size": None,
+        "reupload_file": None,
+    }
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name, nbytes in cls.metered.items():
+            if name in cls.__dict__:
+                setattr(cls, name,
+                        timed(f"storage.{name}", nbytes)(cls.__dict__[name]))
+
+    def __init__(self):
+        # IVs index, file name -> IV, to avoid opening
+        # every file when re-constructing the tables
+        self.ivs = {}
 
     def storage_size(self):
         return 0
@@ -171,39 +977,196 @@ class AccessWrapper(object):
     def load_table(self, name):
         return None
 
-    def upload_table(self, name, table):
+    # writes only if table_version() is still expected_version,
+    # raises TableConflict otherwise.
+    # returns the version of the written table
+    def upload_table(self, name, table, expected_version=ANY_VERSION):
+        return False
+
+    # appends data to the end of a table, wrappers that can
+    # append natively should override this
+    def append_table(self, name, data, expected_version=ANY_VERSION):
+        table = self.load_table(name)
+        if table is None:
+            return False
+        return self.upload_table(name, table + data, expected_version)
+
+    # a cheap token that changes whenever the table changes,
+    # None means that the wrapper can't tell (no caching)
+    def table_version(self, name):
+        return None
+
+    def delete_table(self, name, expected_version=ANY_VERSION):
         return False
 
+    def check_version(self, name, expected_version):
+        if expected_version != ANY_VERSION and \
+           self.table_version(name) != expected_version:
+            raise TableConflict(name)
+
     def load_file_iv(self, file_name):
         return None
 
+    # directories are given as "dir/"
     def file_exists(self, file_name):
         return False
 
+    # files under a directory (recursively), to re-encrypt them
+    # with dir_keys, see SharingUtility.rotate_dirs()
+    def dir_files(self, dir_name):
+        return []
+
     def reupload_file(self, su, file_name):
         return False
 
+    # size of the stored file, None if unknown
+    def file_size(self, file_name):
+        return None
+
+    # called before the tables are re-constructed, wrappers whose
+    # IVs index can be changed by other clients reload it here, once
+    # per rebuild instead of on every file_iv()
+    def refresh_ivs(self):
+        pass
+
+    # IV of a file from the index, falls back to load_file_iv()
+    def file_iv(self, file_name):
+        iv = self.ivs.get(file_name)
+        cache_lookup("ivs", iv is not None)
+        if iv is None:
+            iv = self.load_file_iv(file_name)
+            if iv is not None:
+                self.ivs[file_name] = iv
+        return iv
+
+    # to be called whenever a file gets a new IV
+    def set_file_iv(self, file_name, iv):
+        self.ivs[file_name] = iv
+
+    # to be called whenever a file is removed
+    def drop_file_iv(self, file_name):
+        self.ivs.pop(file_name, None)
+
     def name(self, file_name):
         return file_name
 
-    # generic serializer
+    # asyncio interface of this wrapper, see AsyncAccessWrapper
+    def aio(self):
+        if getattr(self, "async_wrapper", None) is None:
+            self.async_wrapper = AsyncAccessWrapper(self)
+        return self.async_wrapper
+
+    # generic serializer, with the binary codec the other
+    # shapes are serialized as with use_json
     def serialize(self, o):
         if o is None:
             return None
-        return jsonify(o) if self.use_json else picklize(o)
-
-    # generic deserializer
+        codec = self.codec or ("json" if self.use_json else "pickle")
+        if codec == "binary":
+            if not self.use_json or binary_shape(o)[0] != BINARY_PICKLE:
+                return binarize(o)
+            codec = "json"
+        return jsonify(o) if codec == "json" else picklize(o)
+
+    # generic deserializer, reads binary tables with any codec,
+    # json wrappers never unpickle
     def deserialize(self, b):
         if b is None:
             return None
-        return unjsonify(b) if self.use_json else unpicklize(b)
+        codec = self.codec or ("json" if self.use_json else "pickle")
+        if is_binary(b):
+            allow_pickle = codec != "json" and not self.use_json
+            return unbinarize(b, allow_pickle)
+        if codec == "binary":
+            # tables written before switching to binary
+            return unpicklize(b) if b[:1] == b"\x80" else unjsonify(b)
+        return unjsonify(b) if codec == "json" else unpicklize(b)
+
+# asyncio
+#
+# the async operations of SharingUtility run the sync ones in a thread,
+# with the loop of the caller in ASYNC_LOOP. Where a sync operation has
+# independent loads or uploads (tables of different users), it awaits
+# them together on that loop through AsyncAccessWrapper
+
+ASYNC_LOOP = contextvars.ContextVar("async_loop", default=None)
+
+# tables loaded together ahead of their load_named_table(),
+# name -> (version, table), see SharingUtility.prefetch_tables()
+PREFETCHED = contextvars.ContextVar("prefetched", default=None)
+
+# the loop of the async operation running this thread, if any
+def async_loop():
+    loop = ASYNC_LOOP.get()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    # never block the loop's own thread waiting on it
+    return loop if loop is not running else None
+
+class AsyncAccessWrapper(object):
+    """asyncio interface of an AccessWrapper, the blocking methods of
+    the wrapper run in threads so that independent loads and uploads can
+    be awaited together. Wrappers with asynchronous I/O can return a
+    subclass overriding these methods from their aio()"""
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.write_lock = threading.Lock()
+
+    async def run(self, fn, *args):
+        return await asyncio.to_thread(fn, *args)
+
+    async def write(self, fn, *args):
+        if self.wrapper.concurrent_writes:
+            return await asyncio.to_thread(fn, *args)
+        def locked():
+            with self.write_lock:
+                return fn(*args)
+        return await asyncio.to_thread(locked)
+
+    async def list_tables(self):
+        return await self.run(self.wrapper.list_tables)
+
+    async def load_table(self, name):
+        return await self.run(self.wrapper.load_table, name)
+
+    async def table_version(self, name):
+        return await self.run(self.wrapper.table_version, name)
+
+    async def upload_table(self, name, table, expected_version=ANY_VERSION):
+        return await self.write(self.wrapper.upload_table, name, table,
+                                expected_version)
+
+    async def append_table(self, name, data, expected_version=ANY_VERSION):
+        return await self.write(self.wrapper.append_table, name, data,
+                                expected_version)
+
+    async def delete_table(self, name, expected_version=ANY_VERSION):
+        return await self.write(self.wrapper.delete_table, name,
+                                expected_version)
+
+    async def file_exists(self, file_name):
+        return await self.run(self.wrapper.file_exists, file_name)
+
+    async def file_iv(self, file_name):
+        return await self.run(self.wrapper.file_iv, file_name)
+
+    async def reupload_file(self, su, file_name):
+        return await self.write(self.wrapper.reupload_file, su, file_name)
 
 class FakeAccessWrapper(AccessWrapper):
-    def __init__(self, use_json=False):
+    def __init__(self, use_json=False, codec=None):
+        super().__init__()
         self.use_json = use_json
+        self.codec = codec
         self.upload_delay = 0
+        self.load_delay = 0
         self.tables = {}
         self.files  = {}
+        self.versions = {}
+        self.lock = threading.RLock()
 
     def storage_size(self):
         res = 0
@@ -225,15 +1188,40 @@ class FakeAccessWrapper(AccessWrapper):
         return list(self.tables.keys())
 
     def load_table(self, name):
+        time.sleep(self.load_delay)
         if name not in self.tables:
             return None
         else:
             return self.tables[name]
 
-    def upload_table(self, name, table):
-        self.tables[name] = table
+    def upload_table(self, name, table, expected_version=ANY_VERSION):
+        with self.lock:
+            self.check_version(name, expected_version)
+            self.tables[name] = table
+            self.versions[name] = version = self.versions.get(name, 0) + 1
         time.sleep(self.upload_delay)
-        return True
+        return version
+
+    def append_table(self, name, data, expected_version=ANY_VERSION):
+        with self.lock:
+            if name not in self.tables:
+                return False
+            return self.upload_table(name, self.tables[name] + data,
+                                     expected_version)
+
+    def table_version(self, name):
+        if name not in self.tables:
+            return None
+        return self.versions.get(name, 0)
+
+    def delete_table(self, name, expected_version=ANY_VERSION):
+        with self.lock:
+            self.check_version(name, expected_version)
+            if name not in self.tables:
+                return False
+            del self.tables[name]
+            self.versions[name] = self.versions.get(name, 0) + 1
+            return True
 
     def load_file_iv(self, file_name):
         if file_name not in self.files:
@@ -241,19 +1229,31 @@ class FakeAccessWrapper(AccessWrapper):
         return self.files[file_name][:AES.block_size]
 
     def file_exists(self, file_name):
+        if is_dir_entry(file_name):
+            return len(self.dir_files(file_name)) != 0
         return file_name in self.files
 
+    def dir_files(self, dir_name):
+        return [f for f in self.files if entry_covers(dir_name + "/", f)]
+
+    def file_size(self, file_name):
+        if file_name not in self.files:
+            return None
+        return len(self.files[file_name])
+
     def reupload_file(self, su, file_name):
         data = self.load_fake_file(file_name) # load
         if data is None: return False
-        iv = self.load_file_iv(file_name)
-        key = su.key_gen(iv)
-        data = sym_dec(data, key) # decrypt
+        old_iv = self.load_file_iv(file_name)
+        old_key = su.key_gen(old_iv, file_name)
         # create a new iv => new key
         iv = Random.new().read(AES.block_size)
-        key = su.key_gen(iv)
-        data = sym_enc(data, key, iv) # re-encrypt
-        self.files[file_name] = data
+        key = su.key_gen(iv, file_name, rotated=True)
+        # re-encrypt the segments concurrently
+        data = ctr_reencrypt_stream(memoryview(data)[AES.block_size:],
+                                    old_key, old_iv, key, iv)
+        self.files[file_name] = b"".join([iv, *data])
+        self.set_file_iv(file_name, iv)
         time.sleep(self.upload_delay)
         return True
 
@@ -263,9 +1263,12 @@ class FakeAccessWrapper(AccessWrapper):
         if data == None:
             data = bytearray([i % 256 for i in range(size)])
         iv = Random.new().read(AES.block_size)
-        key = su.key_gen(iv)
+        key = su.key_gen(iv, file_name)
         data_enc = sym_enc(data, key, iv)
         self.files[file_name] = data_enc
+        self.set_file_iv(file_name, iv)
+        # the new IV completes a lazy revocation
+        su.rotate_pending([file_name], reupload=False)
         return data, data_enc
 
     def load_fake_file(self, file_name):
@@ -278,61 +1281,102 @@ class FakeAccessWrapper(AccessWrapper):
         data = self.load_fake_file(file_path)
 
         if key == None:
-            key = su.get_shared_file_key(file_path)
+            key = su.get_shared_file_key(file_path,
+                                         iv=data[:AES.block_size])
             if key is None:
                 return None
 
-        data = sym_dec(data, key)
-        return data
+        return b"".join(sym_dec_stream(data, key))
 
     def cleanup(self):
         self.tables = {}
         self.files = {}
+        self.versions = {}
+        self.ivs = {}
 
 class SharingUtility(object):
-    def __init__(self, user_id, passphrase=None, k_sym=None, k_pub=None, k_priv=None, access_wrapper=None, keys_cache=None):
+    def __init__(self, user_id, passphrase=None, k_sym=None, k_pub=None, k_priv=None, access_wrapper=None, keys_cache=None, table_log=False, shard_others=False, lazy_revocation=False, k_pub_getter=None, dir_keys=False):
 
         if "_" in user_id:
             raise Exception(f"'_' is not allowed in SharingUtility's user_id ({user_id})")
+        if is_group(user_id):
+            raise Exception(f"SharingUtility's user_id can't start with '{GROUP_PREFIX}' ({user_id})")
         
         self.user_id = user_id
         self.alice_id = user_id
 
-        keys_read_from_file = False
+        keys = None
         if keys_cache is not None:
             try:
-                with open(keys_cache, "r") as f:
-                    str_keys = json.loads(f.read())
-                keys = unstringify_keys(str_keys)
-                self.k_alice      = keys["sym"]
-                self.k_alice_pub  = keys["pub"]
-                self.k_alice_priv = keys["priv"]
-                keys_read_from_file = True
-            except:
-                keys_read_from_file = False
+                keys = load_keys_cache(keys_cache, passphrase)
+            except Exception:
+                keys = None
+        keys_read_from_file = keys is not None
+        keys_cache_is_old = keys_read_from_file and \
+            not isinstance(keys, LazyKeys)
 
         if not keys_read_from_file:
             if passphrase is not None:
                 keys = gen_keys_from(passphrase)
-                self.k_alice      = keys["sym"]
-                self.k_alice_pub  = keys["pub"]
-                self.k_alice_priv = keys["priv"]
             else:
-                self.k_alice      = k_sym
-                self.k_alice_pub  = k_pub
-                self.k_alice_priv = k_priv
-
-        self.keys = {
-            "sym":  self.k_alice,
-            "pub":  self.k_alice_pub,
-            "priv": self.k_alice_priv
-        }
-
-        self.keys_str = stringify_keys(self.keys)
-
-        if not keys_read_from_file and keys_cache is not None:
-            with open(keys_cache, "w") as f:
-                f.write(json.dumps(self.keys_str))
+                keys = { "sym": k_sym, "pub": k_pub, "priv": k_priv }
+
+        self.keys = keys
+        self.k_alice = keys["sym"]
+
+        # also replaces old json caches with the binary format
+        if keys_cache is not None and \
+           (not keys_read_from_file or keys_cache_is_old):
+            save_keys_cache(keys_cache, keys, passphrase)
+
+        # decrypted tables, name -> (version, serialized table)
+        self.tables_cache = {}
+        # versions of the tables when last read, name -> version,
+        # tables are written only if they still have these versions,
+        # used outside of retry_on_conflict operations
+        self._read_versions = {}
+
+        # keep our tables as append-only logs
+        self.table_log = table_log
+        # logs we know of, name -> (records count, table, version, k_log)
+        self.table_logs = {}
+        # last read logs, name -> (size, H(log), records count, table, k_log)
+        self.logs_cache = {}
+
+        # split T_A_others into one table per user,
+        # table_<alice>_others_<bob> = E({ "bob" -> ["f", ...] }, k_A)
+        self.shard_others = shard_others
+
+        # revoked files are re-encrypted on their next write, or by
+        # drain_pending(), instead of during the revocation
+        self.lazy_revocation = lazy_revocation
+        # function(user_id) returns public key, used to update the
+        # tables once pending files are re-encrypted
+        self.k_pub_getter = k_pub_getter
+        # (version, pending files) as last read, see pending_files()
+        self.pending_cache = None
+
+        # files keys derived from their paths, directories can be shared,
+        # see DIR_KEY_CONTEXT. Files of another mode can't be read
+        self.dir_keys = dir_keys
+        # (version, meta_<alice>_dirs) as last read
+        self.dirs_cache = None
+        # keys of directories, (path, epochs on the path) -> key
+        self.node_keys = {}
+
+        # files shared with us, path -> (key, sharer)
+        self.shared_index = {}
+        # tables the index is built from, sharer -> (version, table)
+        self.shared_tables = {}
+        # bumped whenever shared_tables change, so views built from
+        # them (e.g. ShareFS' /shared) know when to be rebuilt
+        self.shared_generation = 0
+        self.lock = threading.RLock()
+        # serializes the re-encryptions of rotate_dirs() and
+        # rotate_pending(). Files are locked by the wrappers while
+        # re-encrypted, and readers holding these locks may need
+        # self.lock for keys, so self.lock is never held meanwhile
+        self.rotation_lock = threading.RLock()
 
         if access_wrapper == None:
             self.access_wrapper = FakeAccessWrapper()
@@ -344,9 +1388,47 @@ class SharingUtility(object):
             except:
                 pass
 
-    # k_f = H(f_IV | k_A)
-    def key_gen(self, f_IV):
-        return hashlib.sha256(f_IV + self.k_alice).digest()
+    # public and private keys are loaded lazily from the keys cache
+    @property
+    def k_alice_pub(self):
+        return self.keys["pub"]
+
+    @property
+    def k_alice_priv(self):
+        return self.keys["priv"]
+
+    @property
+    def keys_str(self):
+        return stringify_keys(self.keys)
+
+    # k_f = H(f_IV | k_A), with dir_keys k_f = H(f_IV | k_path)
+    # rotated: the key the file gets when re-encrypted, see rotate_dirs()
+    def key_gen(self, f_IV, path=None, rotated=False):
+        if not self.dir_keys or path is None:
+            return hashlib.sha256(f_IV + self.k_alice).digest()
+        return hashlib.sha256(f_IV + self.node_key(path, rotated)).digest()
+
+    # k_path of a file or a directory, see derive_node_key()
+    def node_key(self, path, rotated=False):
+        dirs = self.load_dirs()
+        path = normalize_path(path)
+        epochs = dirs["epochs"]
+        if "next" in dirs and (rotated or path in dirs["moved"]):
+            epochs = dirs["next"]
+
+        comps = path_components(path)
+        parent = comps[:-1]
+        epochs_on_path = tuple(epochs.get("/".join(parent[:i + 1]), 0)
+                               for i in range(len(parent)))
+        cache_key = ("/".join(parent), epochs_on_path)
+        key = self.node_keys.get(cache_key)
+        cache_lookup("node_keys", key is not None)
+        if key is None:
+            root = HKDF(self.k_alice, AES.key_size[-1], b"", SHA256,
+                        context=DIR_KEY_CONTEXT)
+            key = derive_node_key(root, parent, epochs)
+            self.node_keys[cache_key] = key
+        return derive_node_key(key, comps[len(parent):], epochs, parent)
 
     # files Alice share with others:
     # T_A,others = E({ "B" -> ["f", ...], ... }, k_A)
@@ -354,23 +1436,274 @@ class SharingUtility(object):
     # T_A,B      = E({ "f" -> "k_f", ... },      k_Bpub)
 
     def load_table(self, bob_id=None):
-        name = self.get_table_name(bob_id)
-        table = self.access_wrapper.load_table(name)
-        if table == None:
-            return None
+        return self.load_named_table(self.get_table_name(bob_id),
+                                     self.table_decrypter(bob_id))
 
+    def table_decrypter(self, bob_id=None):
         if bob_id == None:
             # files Alice share with others
             key = self.k_alice
-            table = sym_dec(table, key)
+            return lambda data: sym_dec(data, key)
         else:
             # files >>>Bob<<< share with Alice
             key = self.k_alice_priv
-            table = asym_dec(table, key)
+            return lambda data: asym_dec(data, key)
+
+    # see READ_VERSIONS
+    @property
+    def read_versions(self):
+        versions = READ_VERSIONS.get()
+        if versions is None:
+            return self._read_versions
+        return versions.setdefault(id(self), {})
+
+    @timed("sharing.load_table")
+    def load_named_table(self, name, decrypt):
+        prefetched = PREFETCHED.get()
+        if prefetched is not None and name in prefetched:
+            version, blob = prefetched.pop(name)
+        else:
+            version, blob = self.access_wrapper.table_version(name), None
+
+        # avoid decrypting the table again if it did not change
+        table = self.cached_table(name, version)
+        if table is not None:
+            return table
+
+        if blob is None:
+            blob = self.access_wrapper.load_table(name)
+        return self.decode_table(name, version, blob, decrypt)
+
+    def cached_table(self, name, version):
+        if version is not None and name in self.tables_cache:
+            cached_version, s_table = self.tables_cache[name]
+            if cached_version == version:
+                cache_lookup("tables", True)
+                self.read_versions[name] = version
+                # callers modify the tables they load, so every
+                # one of them gets its own copy
+                return self.access_wrapper.deserialize(s_table)
+        cache_lookup("tables", False)
+        return None
 
-        table = self.access_wrapper.deserialize(table)
+    # decrypt and deserialize a loaded table
+    def decode_table(self, name, version, table, decrypt):
+        self.read_versions[name] = version
+        if table == None:
+            self.tables_cache.pop(name, None)
+            return None
+
+        if is_table_log(table):
+            table, s_table = self.read_table_log(name, version, table,
+                                                 decrypt)
+        else:
+            self.table_logs.pop(name, None)
+            s_table = decrypt(table)
+            table = self.access_wrapper.deserialize(s_table)
+        if version is not None:
+            self.tables_cache[name] = (version, s_table)
         return table
 
+    # snapshot + records, only the records added since
+    # the last read are decrypted
+    # returns the table and the table serialized
+    def read_table_log(self, name, version, blob, decrypt):
+        start = None
+        s_table = None
+        log_key = None
+        cached = self.logs_cache.get(name)
+        if cached is not None:
+            size, digest, count, s_table, log_key = cached
+            if len(blob) >= size and \
+               hashlib.sha256(blob[:size]).digest() == digest:
+                table = self.access_wrapper.deserialize(s_table)
+                start = size
+            else:
+                s_table = None
+        cache_lookup("table_logs", start is not None)
+
+        v1 = blob[:len(TABLE_LOG_MAGIC_V1)] == TABLE_LOG_MAGIC_V1
+        for _, frame in log_frames(blob, start):
+            if start is None:
+                # the snapshot, and the key of the records
+                if v1:
+                    log_key, s_frame = None, decrypt(frame)
+                else:
+                    s_frame = decrypt(frame[LOG_NONCE_SIZE:])
+                    log_key = s_frame[:AES.key_size[-1]]
+                    s_frame = s_frame[AES.key_size[-1]:]
+                table = self.access_wrapper.deserialize(s_frame)
+                s_table, count, start = s_frame, 0, 0
+                continue
+            if log_key is None:
+                s_frame = decrypt(frame)
+            else:
+                s_frame = sym_dec(frame, log_key)
+            table = apply_table_record(table,
+                                       self.access_wrapper.deserialize(s_frame))
+            s_table = None
+            count += 1
+        if s_table is None:
+            s_table = self.access_wrapper.serialize(table)
+
+        self.logs_cache[name] = (len(blob), hashlib.sha256(blob).digest(),
+                                 count, s_table, log_key)
+        self.table_logs[name] = (count, s_table, version, log_key)
+        return table, s_table
+
+    # T_A_others, or only the part of it of the given users.
+    # With shard_others, only the shards of these users are read
+    def load_others(self, users=None):
+        if not self.shard_others:
+            return self.load_table() or {}
+
+        # a T_A_others from before sharding, until it gets migrated
+        T_A_others = self.load_table() or {}
+        if users is None:
+            names = self.list_shards()
+        else:
+            T_A_others = {u: T_A_others[u] for u in users if u in T_A_others}
+            names = [self.get_shard_name(u) for u in users]
+
+        decrypt = lambda data: sym_dec(data, self.k_alice)
+        for name in names:
+            shard = self.load_named_table(name, decrypt)
+            if shard is not None:
+                T_A_others.update(shard)
+        return T_A_others
+
+    # files waiting to be re-encrypted after a lazy revocation,
+    # meta_<alice>_pending = E({ "f" -> ["revoked user", ...] }, k_A)
+    def get_pending_name(self):
+        return f"meta_{self.alice_id}_pending"
+
+    def load_pending(self):
+        return self.load_named_table(
+            self.get_pending_name(),
+            lambda data: sym_dec(data, self.k_alice)) or {}
+
+    # names of the pending files, as read by is_pending() on every
+    # write, not to be modified
+    def pending_files(self):
+        return self.cached_pending()[0]
+
+    # the pending names, and their index by normalized path ("dir/"
+    # for the directories), reloaded when the pending table changes
+    def cached_pending(self):
+        name = self.get_pending_name()
+        version = self.access_wrapper.table_version(name)
+        if self.pending_cache is not None and version is not None and \
+           self.pending_cache[0] == version:
+            return self.pending_cache[1:]
+        pending = frozenset(self.load_pending())
+        index = {}
+        for entry in pending:
+            key = normalize_path(entry) + ("/" if is_dir_entry(entry) else "")
+            index.setdefault(key, []).append(entry)
+        self.pending_cache = (version, pending, index)
+        return pending, index
+
+    def upload_pending(self, pending):
+        name = self.get_pending_name()
+        expected = self.expected_version(name)
+        if len(pending) == 0 and self.delete_table(name, expected):
+            return
+        s_pending, data, append = self.encrypt_table(
+            name, pending, lambda data: sym_enc(data, self.k_alice), expected)
+        self.write_table(name, s_pending, data, append, expected)
+
+    # epochs of the directories, with dir_keys,
+    # meta_<alice>_dirs = E({ "epochs": { "dir": n, ... } }, k_A)
+    # while rotate_dirs() runs, it also has the epochs after it ("next"),
+    # the rotated dirs ("dirs"), and the files done so far ("moved")
+    def get_dirs_name(self):
+        return f"meta_{self.alice_id}_dirs"
+
+    # as read by node_key(), not to be modified
+    def load_dirs(self):
+        name = self.get_dirs_name()
+        version = self.access_wrapper.table_version(name)
+        if self.dirs_cache is not None and version is not None and \
+           self.dirs_cache[0] == version:
+            return self.dirs_cache[1]
+        dirs = self.load_named_table(name, self.table_decrypter()) or \
+            { "epochs": {} }
+        if "moved" in dirs:
+            dirs["moved"] = set(dirs["moved"])
+        self.dirs_cache = (version, dirs)
+        return dirs
+
+    # returns the version of the written table
+    def upload_dirs(self, dirs, expected_version=ANY_VERSION):
+        data = self.access_wrapper.serialize(dirs)
+        self.dirs_cache = None
+        return self.upload_table(self.get_dirs_name(),
+                                 sym_enc(data, self.k_alice),
+                                 expected_version)
+
+    # re-encrypt the files under directories with new epochs of the
+    # directories, i.e. new keys for all of them. The files done are
+    # recorded one by one, so the keys of all the files are known if
+    # this gets interrupted, the next rotation finishes it first
+    def rotate_dirs(self, dirs):
+        with self.rotation_lock:
+            name = self.get_dirs_name()
+            decrypt = self.table_decrypter()
+            state = self.load_named_table(name, decrypt) or { "epochs": {} }
+            version = self.expected_version(name)
+            if "next" in state:
+                if not self.move_dir_files(state, version):
+                    return False
+                state = self.load_named_table(name, decrypt)
+                version = self.expected_version(name)
+
+            dirs = [normalize_path(d) for d in dirs]
+            state["next"] = dict(state["epochs"])
+            for d in dirs:
+                state["next"][d] = state["epochs"].get(d, 0) + 1
+            state["dirs"] = dirs
+            state["moved"] = []
+            version = self.upload_dirs(state, version)
+            return self.move_dir_files(state, version)
+
+    def move_dir_files(self, state, version):
+        moved = list(state["moved"])
+        done = set(moved)
+        ok = True
+        for d in state["dirs"]:
+            for f in self.access_wrapper.dir_files(d):
+                if normalize_path(f) in done:
+                    continue
+                if not self.access_wrapper.reupload_file(self, f):
+                    ok = False
+                    continue
+                moved.append(normalize_path(f))
+                done.add(moved[-1])
+                state["moved"] = moved
+                version = self.upload_dirs(state, version)
+        if ok:
+            self.upload_dirs({ "epochs": state["next"] }, version)
+        return ok
+
+    # drops the cached tables changed by others, names: None for all.
+    # tables are checked against their versions anyway, this is for
+    # the ones changed without a new version and to free the memory
+    def forget_tables(self, names=None):
+        with self.lock:
+            if names is None:
+                self.tables_cache.clear()
+                self.logs_cache.clear()
+                self.dirs_cache = None
+                self.pending_cache = None
+                return
+            for name in names:
+                self.tables_cache.pop(name, None)
+                self.logs_cache.pop(name, None)
+                if name == self.get_dirs_name():
+                    self.dirs_cache = None
+                if name == self.get_pending_name():
+                    self.pending_cache = None
+
     def get_table_name(self, bob_id=None, alice_id=None):
         if bob_id == None:
             # files Alice share with others
@@ -383,13 +1716,178 @@ class SharingUtility(object):
             name = f"table_{bob_id}_{self.alice_id}"
         return name
 
-    def upload_table(self, name, table):
-        self.access_wrapper.upload_table(name, table)
+    # Alice's T_A_others shard of one user
+    def get_shard_name(self, bob_id):
+        return f"table_{self.alice_id}_others_{bob_id}"
+
+    def list_shards(self, tables=None):
+        if tables is None:
+            tables = self.access_wrapper.list_tables()
+        prefix = self.get_shard_name("")
+        return [t for t in tables if t.startswith(prefix)]
+
+    def upload_table(self, name, table, expected_version=ANY_VERSION):
+        self.table_changed(name)
+        return self.access_wrapper.upload_table(name, table, expected_version)
+
+    # forget what we read of a table we are writing
+    def table_changed(self, name):
+        self.tables_cache.pop(name, None)
+        self.read_versions.pop(name, None)
+
+    def delete_table(self, name, expected_version=ANY_VERSION):
+        ret = self.access_wrapper.delete_table(name, expected_version)
+        self.tables_cache.pop(name, None)
+        self.read_versions.pop(name, None)
+        self.table_logs.pop(name, None)
+        self.logs_cache.pop(name, None)
+        return ret
+
+    # version to expect when writing back a table we read
+    # (None if never read, i.e. it is a new table)
+    def expected_version(self, name):
+        return self.read_versions.get(name)
+
+    def append_table(self, name, data, expected_version=ANY_VERSION):
+        self.table_changed(name)
+        return self.access_wrapper.append_table(name, data, expected_version)
+
+    # serialize and encrypt a table to be written by write_table(),
+    # in log mode only the changes since the last write are encrypted,
+    # if the log is still at the version to be written over
+    # returns (serialized table, data to write, append?)
+    def encrypt_table(self, name, table, encrypt,
+                      expected_version=ANY_VERSION):
+        s_table = self.access_wrapper.serialize(table)
+        state = self.table_logs.get(name)
+        if self.table_log and state is not None and \
+           state[0] < TABLE_LOG_MAX_RECORDS and \
+           expected_version in (ANY_VERSION, state[2]):
+            old = self.access_wrapper.deserialize(state[1])
+            record = table_diff(old, table)
+            if len(record) == 0:
+                return s_table, None, True
+            record = self.access_wrapper.serialize(record)
+            if state[3] is None:
+                # a log from before k_log
+                return s_table, log_frame(encrypt(record)), True
+            return s_table, log_frame(sym_enc(record, state[3])), True
+        if not self.table_log:
+            return s_table, encrypt(s_table), False
+        nonce = secrets.token_bytes(LOG_NONCE_SIZE)
+        data = nonce + encrypt(self.log_key(name, nonce) + s_table)
+        return s_table, TABLE_LOG_MAGIC + log_frame(data), False
+
+    # k_log of the snapshot of a log, given its nonce
+    def log_key(self, name, nonce):
+        return HKDF(self.k_alice, AES.key_size[-1], nonce, SHA256,
+                    context=LOG_KEY_CONTEXT + name.encode())
+
+    # s_table: the table serialized, as returned by encrypt_table()
+    @timed("sharing.write_table")
+    def write_table(self, name, s_table, data, append,
+                    expected_version=ANY_VERSION):
+        if data is None:
+            return # nothing changed
+        try:
+            if append:
+                version = self.append_table(name, data, expected_version)
+            else:
+                version = self.upload_table(name, data, expected_version)
+        except TableConflict:
+            # our view of the log is old, write a new snapshot next time
+            self.table_logs.pop(name, None)
+            raise
+        self.table_written(name, s_table, data, append, version)
+
+    # data: the written data, version: of the written table,
+    # as returned by the access wrapper
+    def table_written(self, name, s_table, data, append, version):
+        if not self.table_log:
+            return
+        state = self.table_logs.get(name)
+        if append and state is None:
+            # dropped by a concurrent conflict, snapshot next time
+            return
+        if append:
+            count, log_key = state[0] + 1, state[3]
+        else:
+            i = len(TABLE_LOG_MAGIC) + 4
+            count = 0
+            log_key = self.log_key(name, bytes(data[i:i + LOG_NONCE_SIZE]))
+        self.table_logs[name] = (count, s_table, version, log_key)
+
+    # write_table() of tables that don't depend on each other,
+    # uploaded together when running an async operation
+    # writes: [(name, s_table, data, append, expected_version), ...]
+    def write_tables(self, writes):
+        writes = [w for w in writes if w[2] is not None]
+        loop = async_loop()
+        if loop is None or len(writes) < 2:
+            for write in writes:
+                self.write_table(*write)
+            return
+
+        def write(aio, name, data, append, expected):
+            self.table_changed(name)
+            if append:
+                return aio.append_table(name, data, expected)
+            return aio.upload_table(name, data, expected)
+        rets = self.gather_io(loop, [
+            lambda aio, w=w: write(aio, w[0], w[2], w[3], w[4])
+            for w in writes])
+
+        error = None
+        for (name, s_table, data, append, _), ret in zip(writes, rets):
+            if isinstance(ret, BaseException):
+                # see write_table()
+                self.table_logs.pop(name, None)
+                error = error or ret
+            else:
+                self.table_written(name, s_table, data, append, ret)
+        if error is not None:
+            raise error
+
+    # loads tables that don't depend on each other together when
+    # running an async operation, load_named_table() then uses them
+    # until done_prefetching(token)
+    def prefetch_tables(self, names):
+        loop = async_loop()
+        if loop is None or len(names) < 2:
+            return None
+        async def fetch(aio, name):
+            # the version first, as in load_named_table()
+            version = await aio.table_version(name)
+            return version, await aio.load_table(name)
+        rets = self.gather_io(loop, [lambda aio, n=n: fetch(aio, n)
+                                     for n in names])
+        for ret in rets:
+            if isinstance(ret, BaseException):
+                raise ret
+        return PREFETCHED.set(dict(zip(names, rets)))
+
+    def done_prefetching(self, token):
+        if token is not None:
+            PREFETCHED.reset(token)
+
+    # runs calls: [function(aio) -> awaitable, ...] together on the loop
+    # of an async operation, returns their results or exceptions
+    def gather_io(self, loop, calls):
+        aio = self.access_wrapper.aio()
+        async def gather():
+            return await asyncio.gather(*[call(aio) for call in calls],
+                                        return_exceptions=True)
+        return asyncio.run_coroutine_threadsafe(gather(), loop).result()
+
+    # directories ("dir/") can be shared only with dir_keys
+    def check_entry(self, file_path):
+        if is_dir_entry(file_path) and not self.dir_keys:
+            raise Exception(f"Can't share directory {file_path} without dir_keys")
 
     # checks is a file is shared with a user
     def is_shared(self, file_name, user):
         file_name = self.access_wrapper.name(file_name)
-        users = self.list_files_shared_by_us()
+        users = self.load_others([user])
         try:
             files = users[user]
             if file_name in files:
@@ -400,176 +1898,823 @@ class SharingUtility(object):
 
     # share a file from Alice to Bob
     def share_file(self, file_path, bob_id, k_bob_pub):
+        return self.share_files([file_path], bob_id, k_bob_pub)
 
-        # check if this is really needed
-        if self.is_shared(file_path, bob_id):
+    # share many files from Alice to Bob with a single
+    # rewrite of Bob's table
+    @timed("sharing.share_files")
+    @retry_on_conflict
+    def share_files(self, file_paths, bob_id, k_bob_pub):
+
+        # version of T_A_B before reading T_A_others
+        versions = self.shared_table_versions([bob_id])
+
+        # load the files shared by Alice with Bob
+        # if does not exist, create new one
+        T_A_others = self.load_others([bob_id])
+
+        # list of file paths shared with Bob from Alice
+        files_shared_with_bob = T_A_others.get(bob_id, [])
+
+        new_files = []
+        for file_path in file_paths:
+            # clean the file name
+            file_path = self.access_wrapper.name(file_path)
+
+            # check if this is really needed
+            if file_path in files_shared_with_bob or file_path in new_files:
+                continue
+
+            # check if the file exists. If not, skip it
+            self.check_entry(file_path)
+            if not self.access_wrapper.file_exists(file_path):
+                continue
+
+            new_files.append(file_path)
+
+        if len(new_files) == 0:
             return None, None, None, None
 
+        # add the new files
+        T_A_others[bob_id] = files_shared_with_bob + new_files
+
+        # re-construct Bob's table (by Alice)
+        T_A_B = self.build_table(T_A_others[bob_id])
+
+        # upload T_A_B and T_A_others
+        T_A_B, T_A_B_enc = self.upload_shared_table(
+            bob_id, T_A_B, k_bob_pub, versions)
+        T_A_others, T_A_others_enc = self.upload_others_table(
+            T_A_others, [bob_id])
+
+        return T_A_B, T_A_B_enc, T_A_others, T_A_others_enc
+
+    # share a file from Alice with many users at once
+    # bobs: { "bob": k_bob_pub, ... }
+    # returns the list of users the file is newly shared with
+    @timed("sharing.share_file_with")
+    @retry_on_conflict
+    def share_file_with(self, file_path, bobs):
+
         # clean the file name
         file_path = self.access_wrapper.name(file_path)
 
         # check if the file exists. If not, fail
+        self.check_entry(file_path)
         if not self.access_wrapper.file_exists(file_path):
-            return None, None, None, None
+            return []
 
-        # load the files shared by Alice with anyone else
-        # if does not exist, create new one
-        T_A_others = self.load_table() or {}
+        # versions of the T_A_B before reading T_A_others
+        versions = self.shared_table_versions(list(bobs))
 
-        # bob already has a table with us
-        if bob_id in T_A_others:
-            # list of file paths shared with Bob from Alice
-            files_shared_with_bob = T_A_others[bob_id]
+        # load the files shared by Alice with these users
+        # if does not exist, create new one
+        T_A_others = self.load_others(list(bobs))
 
-            # re-construct Bob's table (by Alice)
-            T_A_B = {}
-            for f in files_shared_with_bob:
-                T_A_B[f] = self.key_gen(
-                    self.access_wrapper.load_file_iv(f))
+        # check if this is really needed
+        new_bobs = [bob for bob in bobs
+                    if file_path not in T_A_others.get(bob, [])]
+        if len(new_bobs) == 0:
+            return []
+
+        for bob in new_bobs:
+            T_A_others[bob] = T_A_others.get(bob, []) + [file_path]
+
+        # upload T_A_B of every user then T_A_others once
+        self.upload_shared_tables(T_A_others, new_bobs, bobs.get,
+                                  versions=versions)
+        self.upload_others_table(T_A_others, new_bobs)
+
+        return new_bobs
+
+    # versions of T_A_B of the given users (default: all), to be read
+    # before T_A_others. T_A_B can't be read back by Alice, so they are
+    # written only if they did not change since then, and T_A_others
+    # is written after them. Either way, a T_A_B written from an old
+    # T_A_others is followed by a failing T_A_others upload and a retry
+    def shared_table_versions(self, users=None):
+        if users is None:
+            names = self.list_shared_tables(
+                self.access_wrapper.list_tables())
         else:
-            T_A_B = {}
-            T_A_others[bob_id] = []
-
-        # add the new file
-        T_A_B[file_path] = self.key_gen(
-            self.access_wrapper.load_file_iv(file_path))
-        T_A_others[bob_id].append(file_path)
-
-        # serialize
-        T_A_B      = self.access_wrapper.serialize(T_A_B)
-        T_A_others = self.access_wrapper.serialize(T_A_others)
-
-        # upload T_A_B
-        T_A_B_enc = asym_enc(T_A_B, k_bob_pub)
-        self.upload_table(self.get_table_name(
-            alice_id=self.alice_id,
-            bob_id=bob_id), T_A_B_enc)
-
-        # upload T_A_others
-        T_A_others_enc = sym_enc(T_A_others, self.k_alice)
-        self.upload_table(self.get_table_name(), T_A_others_enc)
+            names = [self.get_table_name(alice_id=self.alice_id, bob_id=u)
+                     for u in users]
+        return {name: self.access_wrapper.table_version(name)
+                for name in names}
+
+    # names of the T_A_B of all users
+    def list_shared_tables(self, tables):
+        names = []
+        for table in tables:
+            parsed = parse_table_name(table)
+            if parsed is not None and parsed[0] == self.alice_id and \
+               parsed[1] != "others":
+                names.append(table)
+        return names
+
+    # re-construct, encrypt, and upload the tables of many users,
+    # files keys are computed once for all the tables
+    # versions: from shared_table_versions(), None to not check them
+    def upload_shared_tables(self, T_A_others, users, k_pub_getter,
+                             versions=None):
+        keys = {}
+        self.access_wrapper.refresh_ivs()
+        writes = []
+        for user in users:
+            T_A_B = self.build_table(T_A_others.get(user, []), keys)
+            name = self.get_table_name(alice_id=self.alice_id, bob_id=user)
+            k_pub = None if is_group(user) else k_pub_getter(user)
+            expected = shared_table_version(versions, name)
+            s_T_A_B, T_A_B_enc, append = self.encrypt_table(
+                name, T_A_B, self.table_encrypter(user, k_pub), expected)
+            writes.append((name, s_T_A_B, T_A_B_enc, append, expected))
+        self.write_tables(writes)
+
+    # T_A_B of a list of files, { "f" -> "k_f", ... }
+    # keys: optional cache of already computed files keys
+    def build_table(self, files, keys=None):
+        if keys is None:
+            keys = {}
+            self.access_wrapper.refresh_ivs()
+        T_A_B = {}
+        for f in files:
+            if is_dir_entry(f):
+                T_A_B.update(self.dir_entry_keys(f))
+                continue
+            if f not in keys:
+                keys[f] = self.key_gen(
+                    self.access_wrapper.file_iv(f), f)
+            T_A_B[f] = keys[f]
+        return T_A_B
+
+    # T_A_B entries of a shared directory, its key and the keys of the
+    # directories under it that are not at the first epoch
+    def dir_entry_keys(self, entry):
+        keys = { entry: self.node_key(entry) }
+        base = path_components(entry)
+        for d, epoch in self.load_dirs()["epochs"].items():
+            comps = path_components(d)
+            if epoch != 0 and len(comps) > len(base) and \
+               comps[:len(base)] == base:
+                sub = entry + "/".join(comps[len(base):]) + "/"
+                keys[sub] = self.node_key(sub)
+        return keys
+
+    # encrypts T_A_B, with k_G for our groups (k_bob_pub is not needed)
+    def table_encrypter(self, bob_id, k_bob_pub):
+        if is_group(bob_id):
+            return self.group_encrypter(bob_id)
+        return lambda data: asym_enc(data, k_bob_pub)
+
+    # serialize, encrypt, and upload T_A_B
+    def upload_shared_table(self, bob_id, T_A_B, k_bob_pub, versions=None):
+        name = self.get_table_name(alice_id=self.alice_id, bob_id=bob_id)
+        expected = shared_table_version(versions, name)
+        s_T_A_B, T_A_B_enc, append = self.encrypt_table(
+            name, T_A_B, self.table_encrypter(bob_id, k_bob_pub), expected)
+        self.write_table(name, s_T_A_B, T_A_B_enc, append, expected)
+        return s_T_A_B, T_A_B_enc
+
+    # serialize, encrypt, and upload T_A_others. With shard_others,
+    # only the shards of the given users (default: all) are written
+    # and the last written shard is returned
+    def upload_others_table(self, T_A_others, users=None):
+        encrypt = lambda data: sym_enc(data, self.k_alice)
+        if not self.shard_others:
+            name = self.get_table_name()
+            expected = self.expected_version(name)
+            s_T_A_others, T_A_others_enc, append = self.encrypt_table(
+                name, T_A_others, encrypt, expected)
+            self.write_table(name, s_T_A_others, T_A_others_enc, append,
+                             expected)
+            return s_T_A_others, T_A_others_enc
+
+        if users is None:
+            users = list(T_A_others)
+        users = list(users)
+
+        # split a T_A_others from before sharding
+        legacy = self.load_table()
+        if legacy is not None:
+            for user in legacy:
+                if user not in users and self.access_wrapper.table_version(
+                        self.get_shard_name(user)) is None:
+                    T_A_others.setdefault(user, legacy[user])
+                    users.append(user)
+
+        s_shard, shard_enc = None, None
+        for user in users:
+            ret = self.upload_shard(user, T_A_others.get(user, []))
+            if ret is not None:
+                s_shard, shard_enc = ret
+
+        if legacy is not None:
+            name = self.get_table_name()
+            self.delete_table(name, self.expected_version(name))
+
+        return s_shard, shard_enc
+
+    def upload_shard(self, user, files):
+        name = self.get_shard_name(user)
+        expected = self.expected_version(name)
+        # users with nothing shared do not need a shard
+        if len(files) == 0 and self.delete_table(name, expected):
+            return None
+        shard = { user: files }
+        s_shard, shard_enc, append = self.encrypt_table(
+            name, shard, lambda data: sym_enc(data, self.k_alice), expected)
+        self.write_table(name, s_shard, shard_enc, append, expected)
+        return s_shard, shard_enc
+
+    # list the users who share files with us (alice)
+    def list_sharers(self, tables=None):
+        if tables is None:
+            tables = self.access_wrapper.list_tables()
+        bobs = []
+        for table in tables:
+            parsed = parse_table_name(table)
+            if parsed is None:
+                continue
+            shared_by, shared_to = parsed
+            # tables shared by no valid user are ignored
+            if shared_to == self.alice_id and shared_by not in bobs and \
+               not is_group(shared_by):
+                bobs.append(shared_by)
+        # groups we are members of
+        for table in tables:
+            parsed = parse_gkey_name(table)
+            if parsed is None:
+                continue
+            owner, group, member = parsed
+            if member == self.alice_id and owner != self.alice_id and \
+               not is_group(owner) and is_valid_group(group):
+                bobs.append(owner + SHARER_SEPARATOR + group)
+        return bobs
+
+    # version of the table of a sharer (user or group), groups also
+    # change with their key
+    def sharer_version(self, sharer):
+        owner, group = split_sharer(sharer)
+        if group is None:
+            return self.access_wrapper.table_version(
+                self.get_table_name(sharer))
+        return (self.access_wrapper.table_version(
+                    self.get_gkey_name(group, self.alice_id, owner)),
+                self.access_wrapper.table_version(
+                    self.get_group_table_name(owner, group)))
+
+    # names of the tables load_sharer_table() reads
+    def sharer_tables(self, sharer):
+        owner, group = split_sharer(sharer)
+        if group is None:
+            return [self.get_table_name(sharer)]
+        return [self.get_gkey_name(group, self.alice_id, owner),
+                self.get_group_table_name(owner, group)]
+
+    # the table of a sharer, i.e. T_B,A or T_B,G of a group we are in
+    def load_sharer_table(self, sharer):
+        owner, group = split_sharer(sharer)
+        if group is None:
+            return self.load_table(sharer)
+        keys = self.load_group_keys(group, owner)
+        if keys is None:
+            return None
+        try:
+            return self.load_named_table(
+                self.get_group_table_name(owner, group),
+                self.group_decrypter(keys))
+        except KeyError:
+            # re-encrypted with a key we did not get yet
+            return None
 
-        return T_A_B, T_A_B_enc, T_A_others, T_A_others_enc
+    # update the index of files shared with us, only tables
+    # that changed since the last refresh are decrypted
+    @timed("sharing.refresh_shared_index")
+    def refresh_shared_index(self):
+        with self.lock:
+            versions = {}
+            for bob in self.list_sharers():
+                versions[bob] = self.sharer_version(bob)
+            tables = {}
+            stale = self.stale_sharers(versions)
+            token = self.prefetch_tables(
+                [name for bob in stale for name in self.sharer_tables(bob)])
+            try:
+                for bob in stale:
+                    tables[bob] = self.load_sharer_table(bob) or {}
+            finally:
+                self.done_prefetching(token)
+            self.update_shared_tables(versions, tables)
+
+    # sharers whose tables changed since the last refresh
+    # versions: { "bob": version of T_B,A, ... }
+    def stale_sharers(self, versions):
+        return [bob for bob in versions
+                if versions[bob] is None or bob not in self.shared_tables or
+                self.shared_tables[bob][0] != versions[bob]]
+
+    # tables: { "bob": T_B,A, ... } of the stale sharers
+    def update_shared_tables(self, versions, tables):
+        with self.lock:
+            # sharers that do not share anything anymore
+            for bob in list(self.shared_tables):
+                if bob not in versions:
+                    _, old = self.shared_tables.pop(bob)
+                    self.update_shared_index(bob, old, {})
+                    self.shared_generation += 1
+
+            for bob in tables:
+                old = self.shared_tables[bob][1] \
+                    if bob in self.shared_tables else None
+                self.shared_tables[bob] = (versions[bob], tables[bob])
+                if old != tables[bob]:
+                    self.update_shared_index(bob, old or {}, tables[bob])
+                    self.shared_generation += 1
+
+    def update_shared_index(self, bob, old, new):
+        for f in old:
+            if f in new or self.shared_index.get(f, (None, None))[1] != bob:
+                continue
+            del self.shared_index[f]
+            # the same path might be shared by someone else too
+            for other in self.shared_tables:
+                if f in self.shared_tables[other][1]:
+                    self.shared_index[f] = \
+                        (self.shared_tables[other][1][f], other)
+                    break
+        for f in new:
+            if f not in self.shared_index or self.shared_index[f][1] == bob:
+                self.shared_index[f] = (new[f], bob)
 
     # list files shared with us (alice) from others
     # default:    { "bob": { "file.txt": b"key", ... }, ... }
     # only_files: [ "file.txt", ... ]
     def list_files_shared_with_us(self, only_files=False):
-        tables = self.access_wrapper.list_tables()
-        bobs = []
-        for table in tables:
-            sp = table.split("_")
-            shared_by = sp[1]
-            shared_to = sp[2]
-            if shared_to == self.alice_id:
-                bobs.append(shared_by)
-
-        if only_files:
-            files = []
-            for bob in bobs:
-                files += list(self.load_table(bob).keys())
-            return files
-        else:
-            sharers = {}
-            for bob in bobs:
-                sharers[bob] = self.load_table(bob)
-            return sharers
+        with self.lock:
+            self.refresh_shared_index()
+            if only_files:
+                files = []
+                for bob in self.shared_tables:
+                    files += list(self.shared_tables[bob][1].keys())
+                return files
+            else:
+                sharers = {}
+                for bob in self.shared_tables:
+                    sharers[bob] = dict(self.shared_tables[bob][1])
+                return sharers
 
     # list files shared by us (alice) to others
     def list_files_shared_by_us(self):
-        return self.load_table() or {}
+        return self.load_others()
 
-    # get k_f of one of the files from list_files_shared_with_us()
-    def get_shared_file_key(self, file_path):
+    # get k_f of one of the files from list_files_shared_with_us(),
+    # or of a file in one of the directories shared with us
+    # iv: of the file, to derive its key from a directory key,
+    #     read from the file if not given
+    @timed("sharing.get_shared_file_key")
+    def get_shared_file_key(self, file_path, sharer=None, iv=None):
 
         # clean the file name
         file_path = self.access_wrapper.name(file_path)
 
-        # map sharers to files lists
-        sharers = self.list_files_shared_with_us()
-        for bob in sharers:
-            files = sharers[bob] # files to keys map
-            if file_path in files:
-                return files[file_path]
+        self.refresh_shared_index()
+        return self.lookup_shared_file_key(file_path, sharer, iv)
+
+    # same as get_shared_file_key() without refreshing the index
+    @timed("sharing.lookup_shared_file_key")
+    def lookup_shared_file_key(self, file_path, sharer=None, iv=None):
+        with self.lock:
+            key = self.lookup_shared_entry(file_path, sharer)
+            if key is not None:
+                return key
+
+            # from the deepest shared directory above the file
+            comps = path_components(file_path)
+            for i in range(len(comps) - 1, 0, -1):
+                d = "/".join(comps[:i]) + "/"
+                k_dir = self.lookup_shared_entry(d, sharer) or \
+                    self.lookup_shared_entry("/" + d, sharer)
+                if k_dir is None:
+                    continue
+                if iv is None:
+                    iv = self.access_wrapper.file_iv(file_path)
+                    if iv is None:
+                        return None
+                node = derive_node_key(k_dir, comps[i:])
+                return hashlib.sha256(iv + node).digest()
+            return None
 
-        return None
+    def lookup_shared_entry(self, name, sharer=None):
+        if sharer is None:
+            entry = self.shared_index.get(name)
+            return entry[0] if entry is not None else None
+        if sharer not in self.shared_tables:
+            return None
+        return self.shared_tables[sharer][1].get(name)
 
     # revoke bob from accessing a file
     # k_pub_getter: function(user_id) returns public key
     def revoke_shared_file(self, file_path, bob_id, k_pub_getter):
-        # print(f">>> revoke_shared_file({file_path}, {bob_id}, {k_pub_getter})")
-
-        # check if this is really needed
-        if not self.is_shared(file_path, bob_id):
+        return self.revoke_many([(file_path, bob_id)], k_pub_getter)
+
+    # revoke bob from accessing all the files we share with him
+    def revoke_user(self, bob_id, k_pub_getter):
+        T_A_others = self.load_others([bob_id])
+        files = T_A_others.get(bob_id, [])
+        return self.revoke_many([(f, bob_id) for f in files], k_pub_getter)
+
+    # revoke many (file, user) pairs at once. Every affected file is
+    # re-encrypted once and every affected table is rewritten once
+    @timed("sharing.revoke_many")
+    @retry_on_conflict
+    def revoke_many(self, revocations, k_pub_getter):
+
+        # versions of T_A_B before reading T_A_others
+        versions = self.shared_table_versions()
+
+        # load the files shared by Alice with anyone else, all users
+        # are needed to find the other tables of the revoked files
+        T_A_others = self.load_others()
+        if len(T_A_others) == 0:
             return False
 
-        # clean the file name
-        file_path = self.access_wrapper.name(file_path)
+        files, bobs = self.remove_revoked(T_A_others, revocations)
 
-        # load the files shared by Alice with anyone else
-        T_A_others = self.load_table()
-        if T_A_others == None:
+        # nothing to revoke
+        if len(files) == 0:
             return False
 
-        # we did not share anything with bob before
-        if bob_id not in T_A_others:
-            return False
+        if self.lazy_revocation:
+            # only the tables of the revoked users are updated now, the
+            # files keep their keys until they are re-encrypted
+            with self.lock:
+                self.k_pub_getter = k_pub_getter
+                self.upload_shared_tables(T_A_others, bobs, k_pub_getter,
+                                          versions=versions)
+                self.upload_others_table(T_A_others, bobs)
+                self.add_pending(revocations, files)
+            return True
+
+        # re-encrypt the files, update the tables of the revoked users
+        # and the ones of all other users who have these files shared with
+        upload_ret = self.rotate_files(files, k_pub_getter,
+                                       T_A_others, bobs, versions=versions)
 
-        # list of file paths shared with Bob from Alice
-        files_shared_with_bob = T_A_others[bob_id]
+        # upload T_A_others
+        self.upload_others_table(T_A_others, bobs)
 
-        # this file is not shared with bob
-        if file_path not in files_shared_with_bob:
-            return False
+        return upload_ret
 
-        # remove the revoked file from the list
-        files_shared_with_bob.remove(file_path)
+    # remove the revoked files from T_A_others
+    # returns (revoked files, revoked users)
+    def remove_revoked(self, T_A_others, revocations):
+        files = []
+        bobs = []
+        for file_path, bob_id in revocations:
+            # clean the file name
+            file_path = self.access_wrapper.name(file_path)
+
+            # this file is not shared with bob
+            if file_path not in T_A_others.get(bob_id, []):
+                continue
+
+            # remove the revoked file from the list
+            T_A_others[bob_id].remove(file_path)
+
+            if file_path not in files:
+                files.append(file_path)
+            if bob_id not in bobs:
+                bobs.append(bob_id)
+        return files, bobs
+
+    @retry_on_conflict
+    def add_pending(self, revocations, files):
+        with self.lock:
+            pending = self.load_pending()
+            for file_path, bob_id in revocations:
+                file_path = self.access_wrapper.name(file_path)
+                if file_path in files and \
+                   bob_id not in pending.get(file_path, []):
+                    pending[file_path] = pending.get(file_path, []) + [bob_id]
+            self.upload_pending(pending)
+
+    # re-encrypt files with new IVs (i.e. new keys) and update the
+    # tables of every user who has any of them shared with, plus the
+    # tables of the given extra users. Each table is rewritten once
+    # reupload: False if the files already got new IVs by the caller,
+    # directories always get new keys here
+    # T_A_others, versions: of the caller's retried operation, the
+    # tables are read (and retried) by update_rotated_tables() otherwise
+    @timed("sharing.rotate_files")
+    def rotate_files(self, files, k_pub_getter, T_A_others=None, users=(),
+                     reupload=True, versions=None):
+        # upload the files, and the files of the directories
+        upload_ret = True
+        dirs = [f for f in files if is_dir_entry(f)]
+        for file_path in files:
+            if reupload and not is_dir_entry(file_path) and \
+               not self.access_wrapper.reupload_file(self, file_path):
+                upload_ret = False
+        if len(dirs) != 0 and not self.rotate_dirs(dirs):
+            upload_ret = False
+
+        if T_A_others is None:
+            self.update_rotated_tables(files, k_pub_getter, users)
+            return upload_ret
+
+        affected = self.affected_users(T_A_others, files, users)
+        self.upload_shared_tables(T_A_others, affected, k_pub_getter,
+                                  versions=versions)
 
-        # re-construct Bob's table (by Alice)
-        T_A_B = {}
-        for f in files_shared_with_bob:
-            T_A_B[f] = self.key_gen(
-                    self.access_wrapper.load_file_iv(f))
+        return upload_ret
 
-        # serialize tables
-        s_T_A_B      = self.access_wrapper.serialize(T_A_B)
-        s_T_A_others = self.access_wrapper.serialize(T_A_others)
+    # rewrite the tables affected by new keys of files. The versions
+    # of the tables are read before the IVs of the files, so a table
+    # built with older IVs never replaces one built with newer IVs
+    @retry_on_conflict
+    def update_rotated_tables(self, files, k_pub_getter, users=()):
+        versions = self.shared_table_versions()
+        T_A_others = self.load_others()
+        affected = self.affected_users(T_A_others, files, users)
+        self.upload_shared_tables(T_A_others, affected, k_pub_getter,
+                                  versions=versions)
+
+    # the users whose tables are affected by new keys of files
+    def affected_users(self, T_A_others, files, users=()):
+        affected = []
+        for user in T_A_others:
+            if user in users or \
+               self.entries_affected(T_A_others[user], files):
+                affected.append(user)
+        for user in users:
+            if user not in affected:
+                affected.append(user)
+        return affected
+
+    # checks if new keys of files change the keys of shared entries,
+    # with directories, files under them and directories above them
+    def entries_affected(self, entries, files):
+        if not self.dir_keys:
+            return any(f in entries for f in files)
+        return any(entry_covers(e, f) or entry_covers(f, e)
+                   for e in entries for f in files)
+
+    # checks if a file is waiting to be re-encrypted after a
+    # lazy revocation, by itself or with a directory above it.
+    # Wrappers check this before writing our files
+    def is_pending(self, file_path):
+        if not self.lazy_revocation:
+            return False
+        _, index = self.cached_pending()
+        if len(index) == 0:
+            return False
+        comps = path_components(self.access_wrapper.name(file_path))
+        keys = ["/".join(comps[:i]) + "/" for i in range(1, len(comps) + 1)]
+        keys.append("/".join(comps))
+        return any(k in index for k in keys)
+
+    # re-encrypt pending files (default: all) and update the tables of
+    # the users who still have them shared with. A file under a pending
+    # directory rotates the whole directory
+    # reupload: False if the files already got new IVs by the caller,
+    # i.e. they were just re-written
+    @timed("sharing.rotate_pending")
+    def rotate_pending(self, files=None, k_pub_getter=None, reupload=True):
+        with self.rotation_lock:
+            with self.lock:
+                pending = self.load_pending()
+                if files is None:
+                    files = list(pending)
+                else:
+                    names = [self.access_wrapper.name(f) for f in files]
+                    files = [e for e in pending
+                             if any(entry_covers(e, f) for f in names)]
+                if len(files) == 0:
+                    return True
+
+                k_pub_getter = k_pub_getter or self.k_pub_getter
+                if k_pub_getter is None:
+                    raise Exception("Public keys are needed to re-encrypt pending files")
+
+            # without self.lock, see rotation_lock
+            ret = self.rotate_files(files, k_pub_getter, reupload=reupload)
+            # failed ones are tried again by the next write or drain
+            if ret:
+                self.drop_pending(files)
+            return ret
+
+    # forget pending files that got re-encrypted
+    @retry_on_conflict
+    def drop_pending(self, files):
+        with self.lock:
+            pending = self.load_pending()
+            files = [f for f in files if f in pending]
+            if len(files) == 0:
+                return
+            for f in files:
+                del pending[f]
+            self.upload_pending(pending)
+
+    # re-encrypt up to limit pending files, to be called in the
+    # background. Returns the number of files left
+    def drain_pending(self, k_pub_getter=None, limit=None):
+        files = list(self.load_pending())
+        if limit is not None:
+            files = files[:limit]
+        self.rotate_pending(files, k_pub_getter)
+        return len(self.load_pending())
+
+    # re-encrypt many files in the background with a bounded workers
+    # pool and throttled I/O, see core.rotation.RotationWorker
+    def rotation_worker(self, files, k_pub_getter=None, **kwargs):
+        from core.rotation import RotationWorker
+        return RotationWorker(self, files, k_pub_getter or self.k_pub_getter,
+                              **kwargs)
+
+    # groups, see GROUP_PREFIX
+
+    def get_gkey_name(self, group, member, owner=None):
+        return f"gkey_{owner or self.alice_id}_{group}_{member}"
+
+    def get_group_table_name(self, owner, group):
+        return f"table_{owner}_{group}"
+
+    # our own copy of k_G is wrapped with k_A
+    def gkey_decrypter(self, owner):
+        if owner == self.alice_id:
+            return self.table_decrypter()
+        return self.table_decrypter(owner)
+
+    # { "key": k_G, "prev": previous k_G } of a group, ours by default
+    def load_group_keys(self, group, owner=None):
+        owner = owner or self.alice_id
+        return self.load_named_table(
+            self.get_gkey_name(group, self.alice_id, owner),
+            self.gkey_decrypter(owner))
+
+    def upload_group_keys(self, group, member, keys, k_member_pub=None,
+                          expected_version=ANY_VERSION):
+        data = self.access_wrapper.serialize(keys)
+        if member == self.alice_id:
+            data = sym_enc(data, self.k_alice)
+        else:
+            data = asym_enc(data, k_member_pub)
+        self.upload_table(self.get_gkey_name(group, member), data,
+                          expected_version)
+
+    def group_encrypter(self, group):
+        keys = self.load_group_keys(group)
+        if keys is None:
+            raise Exception(f"No such group {group}")
+        key = keys["key"]
+        key_id = group_key_id(key)
+        return lambda data: key_id + sym_enc(data, key)
+
+    def group_decrypter(self, keys):
+        keys = { group_key_id(k): k for k in (keys["key"], keys.get("prev"))
+                 if k is not None }
+        return lambda data: sym_dec(
+            data[GROUP_KEY_ID_SIZE:], keys[bytes(data[:GROUP_KEY_ID_SIZE])])
+
+    # create a group of ours, files are shared with it like with
+    # a user, e.g. share_file("f", "@team", None)
+    # members: { "bob": k_bob_pub, ... }
+    # returns the group id
+    def create_group(self, group, members=None):
+        group = group_id(group)
+        check_group(group)
+        if self.load_group_keys(group) is not None:
+            raise Exception(f"Group {group} already exists")
+        keys = { "key": secrets.token_bytes(nbytes=int(AES.key_size[-1])) }
+        self.upload_group_keys(group, self.alice_id, keys,
+                               expected_version=None)
+        self.add_group_members(group, members or {})
+        return group
+
+    # members get k_G, and so all the files shared with the group
+    # members: { "bob": k_bob_pub, ... }
+    def add_group_members(self, group, members):
+        group = group_id(group)
+        keys = self.load_group_keys(group)
+        if keys is None:
+            raise Exception(f"No such group {group}")
+        for member, k_pub in members.items():
+            self.upload_group_keys(group, member, keys, k_pub)
+
+    # removed members lose the group, k_G is rotated so they can not
+    # read its table anymore. Files are not re-encrypted, removed members
+    # keep the keys of files they already read until the files are
+    # revoked from the group (i.e. revoke_shared_file("f", "@team", ...))
+    # k_pub_getter: function(user_id) returns public key
+    @timed("sharing.remove_group_members")
+    @retry_on_conflict
+    def remove_group_members(self, group, members, k_pub_getter):
+        group = group_id(group)
+
+        # versions of T_A_G and k_G before reading T_A_others
+        versions = self.shared_table_versions([group])
+        keys = self.load_group_keys(group)
+        if keys is None:
+            raise Exception(f"No such group {group}")
+        expected = self.expected_version(
+            self.get_gkey_name(group, self.alice_id))
+        T_A_others = self.load_others([group])
+
+        remaining = [m for m in self.list_group_members(group)
+                     if m not in members]
+        keys = { "key": secrets.token_bytes(nbytes=int(AES.key_size[-1])),
+                 "prev": keys["key"] }
+        self.upload_group_keys(group, self.alice_id, keys,
+                               expected_version=expected)
+        for member in remaining:
+            self.upload_group_keys(group, member, keys, k_pub_getter(member))
+
+        # T_A_G last, members read it with the previous key meanwhile.
+        # It is re-written whole since the log is of the previous key
+        name = self.get_table_name(alice_id=self.alice_id, bob_id=group)
+        self.table_logs.pop(name, None)
+        T_A_G = self.build_table(T_A_others.get(group, []))
+        self.upload_shared_table(group, T_A_G, None, versions)
+
+        for member in members:
+            self.delete_table(self.get_gkey_name(group, member))
+
+    # revoke the files shared with a group and remove the group
+    def delete_group(self, group, k_pub_getter):
+        group = group_id(group)
+        self.revoke_user(group, k_pub_getter)
+        for member in self.list_group_members(group):
+            self.delete_table(self.get_gkey_name(group, member))
+        self.delete_table(self.get_table_name(alice_id=self.alice_id,
+                                              bob_id=group))
+        self.delete_table(self.get_gkey_name(group, self.alice_id))
+
+    def list_group_members(self, group, tables=None):
+        group = group_id(group)
+        if tables is None:
+            tables = self.access_wrapper.list_tables()
+        members = []
+        for table in tables:
+            parsed = parse_gkey_name(table)
+            if parsed is not None and parsed[0] == self.alice_id and \
+               parsed[1] == group and parsed[2] != self.alice_id:
+                members.append(parsed[2])
+        return members
+
+    # our groups
+    def list_groups(self, tables=None):
+        if tables is None:
+            tables = self.access_wrapper.list_tables()
+        groups = []
+        for table in tables:
+            parsed = parse_gkey_name(table)
+            if parsed is not None and parsed[0] == self.alice_id and \
+               parsed[2] == self.alice_id:
+                groups.append(parsed[1])
+        return groups
+
+    # asyncio
+    #
+    # async versions of share_file(), revoke_shared_file(), and
+    # list_files_shared_with_us(). They run the sync operations in a
+    # thread, so the event loop is not blocked by the crypto, and behave
+    # the same (directories, groups, retries...). The uploads of the
+    # tables of different users, and the loads of the tables of
+    # different sharers, are awaited together on the caller's loop
+
+    async def run_async(self, fn, *args):
+        token = ASYNC_LOOP.set(asyncio.get_running_loop())
+        try:
+            # the thread runs in a copy of the context, with the loop
+            return await asyncio.to_thread(fn, *args)
+        finally:
+            ASYNC_LOOP.reset(token)
 
-        # upload T_A_B
-        T_A_B_enc = asym_enc(s_T_A_B, k_pub_getter(bob_id))
-        self.upload_table(self.get_table_name(
-            alice_id=self.alice_id,
-            bob_id=bob_id), T_A_B_enc)
+    async def ashare_file(self, file_path, bob_id, k_bob_pub):
+        return await self.run_async(self.share_file, file_path, bob_id,
+                                    k_bob_pub)
 
-        # upload T_A_others
-        T_A_others_enc = sym_enc(s_T_A_others, self.k_alice)
-        self.upload_table(self.get_table_name(), T_A_others_enc)
+    async def ashare_files(self, file_paths, bob_id, k_bob_pub):
+        return await self.run_async(self.share_files, file_paths, bob_id,
+                                    k_bob_pub)
 
-        # upload the file
-        upload_ret = self.access_wrapper.reupload_file(self, file_path)
+    async def ashare_file_with(self, file_path, bobs):
+        return await self.run_async(self.share_file_with, file_path, bobs)
 
-        # update tables of all other users who have this file shared with
-        T_A_ = {}
-        # for every user we share something with
-        for user in T_A_others:
-            # if we share this particular file
-            if file_path in T_A_others[user]:
-                # recontruct the table for that person
-                # to update the changed key for the newly
-                # revoked file for bob
-                T_A_[user] = {}
-                for f in T_A_others[user]:
-                    T_A_[user][f] = self.key_gen(
-                        self.access_wrapper.load_file_iv(f))
-                # serialize
-                s_T_A_user = self.access_wrapper.serialize(T_A_[user])
-                # upload
-                e_T_A_user = asym_enc(s_T_A_user, k_pub_getter(user))
-                self.upload_table(self.get_table_name(
-                    alice_id=self.alice_id,
-                    bob_id=user), e_T_A_user)
+    async def arevoke_shared_file(self, file_path, bob_id, k_pub_getter):
+        return await self.run_async(self.revoke_shared_file, file_path,
+                                    bob_id, k_pub_getter)
 
-        return upload_ret
+    async def arevoke_many(self, revocations, k_pub_getter):
+        return await self.run_async(self.revoke_many, revocations,
+                                    k_pub_getter)
+
+    async def arefresh_shared_index(self):
+        return await self.run_async(self.refresh_shared_index)
+
+    async def alist_files_shared_with_us(self, only_files=False):
+        return await self.run_async(self.list_files_shared_with_us,
+                                    only_files)
 
     def relative_path(self, file_path):
         return self.access_wrapper.name(file_path)
@@ -3,9 +3,10 @@ import os
 import math
 import hashlib
 
-from errno     import EACCES
-from os.path   import realpath
-from threading import Lock
+from errno      import EACCES
+from os.path    import realpath, normpath
+from threading  import Lock, Condition
+from contextlib import contextmanager
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
@@ -19,6 +20,65 @@ def log(msg):
     if LOG:
         print(msg)
 
+# number of locks the files are spread over, see StripedLocks
+LOCK_STRIPES = 256
+
+class RWLock:
+    """Readers-writer lock. Waiting writers block new readers,
+    so a busy file still gets written"""
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writing = False
+        self.writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            while self.writing or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writing or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+class StripedLocks:
+    """Readers-writer locks of files by their real paths. Files are
+    hashed over a fixed number of locks, so unrelated files rarely
+    wait for each other, with no lock per file to keep around"""
+
+    def __init__(self, stripes=LOCK_STRIPES):
+        self.locks = [RWLock() for _ in range(stripes)]
+
+    def lock(self, path):
+        return self.locks[hash(normpath(path)) % len(self.locks)]
+
+    def read(self, path):
+        return self.lock(path).read()
+
+    def write(self, path):
+        return self.lock(path).write()
+
 class CryptoFS(LoggingMixIn, Operations):
     """Files are stored as follows:
     +----+--------------+--------+---------+
@@ -31,7 +91,9 @@ class CryptoFS(LoggingMixIn, Operations):
         self.root = realpath(root)
         self.mount = realpath(mount)
         self.block_size = AES.block_size
-        self.rwlock = Lock()
+        # files are read with os.pread(), so the same file (and fh) can
+        # be read by many threads at once
+        self.locks = StripedLocks()
 
     def __call__(self, op, path, *args):
         log(f">>> __call__({op}, {path})")
@@ -73,13 +135,12 @@ class CryptoFS(LoggingMixIn, Operations):
         attr['st_size'] -= (self.block_size + 1)
         # hide the padding itself
         try:
-            with self.rwlock:
+            with self.locks.read(path):
                 if fh is None:
                     tmpf = os.open(path, os.O_RDONLY)
                 else:
                     tmpf = fh
-                os.lseek(tmpf, self.block_size, os.SEEK_SET)
-                padding_size = os.read(tmpf, 1)
+                padding_size = os.pread(tmpf, 1, self.block_size)
                 padding_size = int.from_bytes(padding_size, "big")
                 if fh is None:
                     os.close(tmpf)
@@ -159,8 +220,9 @@ class CryptoFS(LoggingMixIn, Operations):
         path = self.translate_path(path)
         # add the length of the file size and the IV
         length += self.block_size
-        with open(path, 'rb+') as f:
-            f.truncate(length)
+        with self.locks.write(path):
+            with open(path, 'rb+') as f:
+                f.truncate(length)
 
     def unlink(self, path):
         path = self.translate_path(path)
@@ -174,7 +236,7 @@ class CryptoFS(LoggingMixIn, Operations):
         log(f">>> read({path}, {size}, {offset}, {fh})")
         virt_path = path
         path = self.translate_path(path)
-        with self.rwlock:
+        with self.locks.read(path):
             plaintext, first_block_num, seq_size, file_size, iv = \
                 self.read_blocks(path, virt_path, size, offset, fh)
 
@@ -187,86 +249,78 @@ class CryptoFS(LoggingMixIn, Operations):
         virt_path = path
         path = self.translate_path(path)
         size = len(data)
-        with self.rwlock:
+        with self.locks.write(path):
             # this is needed to ensure that the file is written to the disk.
             # otherwise, large files will cause "bad file descriptor"
             fh = os.open(path, os.O_RDWR)
-            
-            plaintext, first_block_num, seq_size, file_size, iv = \
-                self.read_blocks(path, virt_path, size, offset, fh)
-            is_new = not bool(iv)
-
-            log(f">>>> {plaintext}, {first_block_num}, {seq_size}, {file_size}, {iv}\n")
-
-            if is_new:
-                log(">>>> new file")
-                if offset != 0:
-                    # writing with an offset to a new file
-                    return -1
-                # create a new IV
-                iv = get_random_bytes(self.block_size)
-                new_data = data
-            else:
-                log(">>>> modifying existing file")
-                # concat the changed parts with the old parts
-                offset_rem = offset % self.block_size
-                new_data = plaintext[0:offset_rem] + data + plaintext[offset_rem + size:]
-
-            # if at the end of the file, pad
-            if offset + size >= file_size:
-                log(">>>> padding")
-                #log(new_data)
-                padding_size = math.ceil(len(new_data) / self.block_size) * self.block_size - len(new_data)
-                log(f">>>> len(new_data)={len(new_data)}, padding_size={padding_size}")
-                new_data = new_data + bytes([padding_size] * padding_size)
-
-            # create the cipher and encrypt
-            cipher = self.mkcipher(virt_path, iv, first_block_num)
-            ciphertext = cipher.encrypt(new_data)
-            #log(">>>> plaintext:")
+            try:
+                return self.write_blocks(path, virt_path, data, offset, fh)
+            finally:
+                os.close(fh)
+
+    def write_blocks(self, path, virt_path, data, offset, fh):
+        size = len(data)
+        plaintext, first_block_num, seq_size, file_size, iv = \
+            self.read_blocks(path, virt_path, size, offset, fh)
+        is_new = not bool(iv)
+
+        log(f">>>> {plaintext}, {first_block_num}, {seq_size}, {file_size}, {iv}\n")
+
+        if is_new:
+            log(">>>> new file")
+            if offset != 0:
+                # writing with an offset to a new file
+                return -1
+            # create a new IV
+            iv = get_random_bytes(self.block_size)
+            new_data = data
+        else:
+            log(">>>> modifying existing file")
+            # concat the changed parts with the old parts
+            offset_rem = offset % self.block_size
+            new_data = plaintext[0:offset_rem] + data + plaintext[offset_rem + size:]
+
+        # if at the end of the file, pad
+        padding_size = None
+        if offset + size >= file_size:
+            log(">>>> padding")
             #log(new_data)
-            #log(">>>> ciphertext:")
-            #log(ciphertext)
-            #log(ciphertext.hex())
-            #log(">>>> iv:")
-            #log(iv.hex())
-
-            if is_new:
-                # write the new data with the iv and padding_size
-                os.lseek(fh, 0, os.SEEK_SET)
-                ret = os.write(fh, iv)
-                if ret != len(iv):
-                    ret = -1
-                else:
-                    ret = os.write(fh, bytes([padding_size]))
-                    if ret != 1:
-                        ret = -1
-                    else:
-                        ret = os.write(fh, ciphertext)
+            padding_size = math.ceil(len(new_data) / self.block_size) * self.block_size - len(new_data)
+            log(f">>>> len(new_data)={len(new_data)}, padding_size={padding_size}")
+            new_data = new_data + bytes([padding_size] * padding_size)
+
+        # create the cipher and encrypt
+        cipher = self.mkcipher(virt_path, iv, first_block_num)
+        ciphertext = cipher.encrypt(new_data)
+
+        if is_new:
+            # write the new data with the iv and padding_size
+            ret = os.pwrite(fh, iv + bytes([padding_size]), 0)
+            if ret != len(iv) + 1:
+                ret = -1
             else:
-                # write the new padding_size
-                log(f">>>> os.lseek({fh}, {self.block_size}, os.SEEK_SET)")
-                os.lseek(fh, self.block_size, os.SEEK_SET)
-                log(f">>>> ret = os.write({fh}, {bytes([padding_size])})")
-                ret = os.write(fh, bytes([padding_size]))
+                # the file has the new IV only once it is written
+                self.iv_changed(virt_path, iv)
+                ret = os.pwrite(fh, ciphertext, self.block_size + 1)
+        else:
+            # write the new padding_size, if the end was written
+            ret = 1
+            if padding_size is not None:
+                log(f">>>> ret = os.pwrite({fh}, {bytes([padding_size])}, {self.block_size})")
+                ret = os.pwrite(fh, bytes([padding_size]), self.block_size)
                 log(f"<<<< {ret}")
-                if ret != 1:
-                    ret = -1
-                else:
-                    # write back the new data
-                    log(f">>>> os.lseek({fh}, {self.block_size} + 1 + {first_block_num} * {self.block_size}, os.SEEK_SET)")
-                    os.lseek(fh, self.block_size + 1 + first_block_num * self.block_size, os.SEEK_SET)
-                    log(f">>>> ret = os.write({fh}, {ciphertext})")
-                    ret = os.write(fh, ciphertext)
-                    log(f"<<<< {ret}")
-
-            if ret != len(ciphertext):
+            if ret != 1:
                 ret = -1
             else:
-                ret = size
+                # write back the new data
+                log(f">>>> ret = os.pwrite({fh}, {ciphertext}, {self.block_size} + 1 + {first_block_num} * {self.block_size})")
+                ret = os.pwrite(fh, ciphertext, self.block_size + 1 +
+                                first_block_num * self.block_size)
+                log(f"<<<< {ret}")
 
-            os.close(fh)
-            return ret
+        if ret != len(ciphertext):
+            return -1
+        return size
 
     # below are extra functions unrelated to fuse
 
@@ -296,10 +350,9 @@ class CryptoFS(LoggingMixIn, Operations):
             log("does not exist")
             return b'', 0, 0, 0, b''
 
-        os.lseek(fh, 0, os.SEEK_SET)
-
+        # positioned reads, fh can be read by other threads at once
         try:
-            iv = os.read(fh, self.block_size)
+            iv = os.pread(fh, self.block_size, 0)
         except Exception as e:
             log(">>>> err: couldn't get the iv")
             log(e)
@@ -311,7 +364,7 @@ class CryptoFS(LoggingMixIn, Operations):
             return b'', 0, 0, 0, iv
 
         try:
-            padding_size = os.read(fh, 1)
+            padding_size = os.pread(fh, 1, self.block_size)
         except:
             log(">>>> err: couldn't get padding size")
             return b'', 0, 0, 0, iv
@@ -325,9 +378,11 @@ class CryptoFS(LoggingMixIn, Operations):
 
         # real file size = size of the encrypted file - size of the IV
         #                  - size of the padding_size - padding_size itself
-        file_size = os.path.getsize(path) - self.block_size - 1 - padding_size
+        # of fh, path might be replaced meanwhile (e.g. re-encrypted)
+        enc_size = os.fstat(fh).st_size
+        file_size = enc_size - self.block_size - 1 - padding_size
         log(path)
-        log(os.path.getsize(path))
+        log(enc_size)
         log(file_size)
 
         if offset > file_size:
@@ -347,8 +402,8 @@ class CryptoFS(LoggingMixIn, Operations):
             seq_size += self.block_size - ((offset + size) % self.block_size)
 
         # read block sequence, skip the iv and padding_size
-        os.lseek(fh, self.block_size + 1 + first_block_num * self.block_size, os.SEEK_SET)
-        blocks = os.read(fh, seq_size)
+        blocks = os.pread(fh, seq_size,
+                          self.block_size + 1 + first_block_num * self.block_size)
 
         if len(blocks) != seq_size:
             log(">>>> err: couldn't read the whole seq_size")
@@ -384,6 +439,11 @@ class CryptoFS(LoggingMixIn, Operations):
         path = self.translate_path(path)
         return os.listdir(path)
 
+    def iv_changed(self, path, iv):
+        """To be overridden in a child class, called when a file gets
+        a new IV"""
+        pass
+
     def fsname(self):
         """Label of the filesystem"""
         return self.__class__.__name__
@@ -392,8 +452,10 @@ class CryptoFS(LoggingMixIn, Operations):
         """Mounts encrypted <root> to <mount> using <fs> (e.g. CryptoFS)"""
         if LOG:
             logging.basicConfig(level=logging.DEBUG)
+        # multithreaded, operations on different files (or reads of the
+        # same file) run in parallel, see StripedLocks
         return FUSE(self, self.mount, foreground=True, allow_other=True,
-                    fsname=self.fsname())
+                    nothreads=False, fsname=self.fsname())
 
 def main(args):
     CryptoFS(args[1], args[2]).start()
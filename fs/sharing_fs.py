@@ -2,14 +2,25 @@ import os
 import shutil
 import socket
 import json
+import fcntl
 import threading
+from contextlib import contextmanager
 
-from errno import EACCES
+from errno import EACCES, ENOENT
 from fuse  import FuseOSError
 
-from core.sharing   import SharingUtility, AccessWrapper
+from core.sharing   import SharingUtility, AccessWrapper, ctr_reencrypt_stream
+from core.sharing   import ANY_VERSION, TableConflict, sharer_owner, \
+    normalize_path, path_components, is_dir_entry
+from core.metrics   import cache_lookup
 from public_key.pki import pki_interface
 from fs.crypto_fs   import CryptoFS
+from fs.watcher     import watch
+from Crypto.Random  import get_random_bytes
+
+# tries to re-encrypt a file without locking FUSE,
+# the last one locks it for the whole re-encryption
+REUPLOAD_ATTEMPTS = 3
 
 LOG = False
 def log(msg):
@@ -18,6 +29,7 @@ def log(msg):
 
 class FSAccessWrapper(AccessWrapper):
     def __init__(self):
+        super().__init__()
         self.fs = None
 
     # override
@@ -48,11 +60,50 @@ class FSAccessWrapper(AccessWrapper):
             return None
 
     # override
-    def upload_table(self, name, table):
-        with open(f"{self.tables_dir()}/{name}", "wb") as f:
+    def upload_table(self, name, table, expected_version=ANY_VERSION):
+        p = f"{self.tables_dir()}/{name}"
+        # written out of the tables directory, then renamed over the
+        # table, so readers never see a partially written table
+        tmp = f"{self.tables_dir()}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp, "wb") as f:
             f.write(table)
+        with self.tables_lock():
+            try:
+                self.check_version(name, expected_version)
+            except TableConflict:
+                os.remove(tmp)
+                raise
+            os.replace(tmp, p)
+            return self.table_version(name)
+
+    # override
+    def append_table(self, name, data, expected_version=ANY_VERSION):
+        p = f"{self.tables_dir()}/{name}"
+        with self.tables_lock():
+            self.check_version(name, expected_version)
+            if not os.path.exists(p):
+                return False
+            with open(p, "ab") as f:
+                f.write(data)
+            return self.table_version(name)
+
+    # override
+    def table_version(self, name):
+        try:
+            st = os.stat(f"{self.tables_dir()}/{name}")
+        except (OSError, TypeError):
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    # override
+    def delete_table(self, name, expected_version=ANY_VERSION):
+        with self.tables_lock():
+            self.check_version(name, expected_version)
+            try:
+                os.remove(f"{self.tables_dir()}/{name}")
+            except (OSError, TypeError):
+                return False
             return True
-        return False
 
     # override
     def load_file_iv(self, file_name):
@@ -71,6 +122,31 @@ class FSAccessWrapper(AccessWrapper):
             return False
         return os.path.exists(f"{self.fs.mount}/{file_name}")
 
+    # override
+    def dir_files(self, dir_name):
+        if self.fs is None:
+            return []
+        user_root = f"{self.fs.root}/{self.fs.su.user_id}"
+        files = []
+        for parent, _, names in os.walk(
+                f"{user_root}/{normalize_path(dir_name)}"):
+            for name in names:
+                p = os.path.relpath(f"{parent}/{name}", user_root)
+                files.append(self.iv_name(p))
+        return files
+
+    # override
+    def file_iv(self, file_name):
+        return super().file_iv(self.iv_name(file_name))
+
+    # override
+    def set_file_iv(self, file_name, iv):
+        super().set_file_iv(self.iv_name(file_name), iv)
+
+    # override
+    def drop_file_iv(self, file_name):
+        super().drop_file_iv(self.iv_name(file_name))
+
     # override
     def reupload_file(self, su, file_name):
         if self.fs is None:
@@ -78,14 +154,100 @@ class FSAccessWrapper(AccessWrapper):
         # remove unlinked iv if any
         if file_name in self.fs.unlinked_ivs:
             del self.fs.unlinked_ivs[file_name]
-        file_name = f"{self.fs.mount}/{file_name}"
-        tmp = f"{file_name}___tmp"
-        shutil.copy2(file_name, tmp)
-        shutil.move(tmp, file_name)
-        return True
+        # re-encrypt the stored file directly, segments are
+        # re-encrypted concurrently and streamed to a tmp file.
+        # the file is only locked while the tmp file replaces the
+        # original, unless it keeps getting written meanwhile.
+        # su.lock must not be held, readers holding the file lock
+        # take it to get keys (see SharingUtility.rotation_lock)
+        p = f"{self.fs.root}/{self.fs.su.user_id}/{file_name.lstrip('/')}"
+        tmp = f"{p}___tmp"
+        for attempt in range(REUPLOAD_ATTEMPTS):
+            if attempt == REUPLOAD_ATTEMPTS - 1:
+                with self.fs.locks.write(p):
+                    return self.reencrypt_file(su, file_name, p, tmp) \
+                        is not None
+            st = os.stat(p)
+            iv = self.reencrypt_file(su, file_name, p, tmp, replace=False)
+            if not iv:
+                return False
+            with self.fs.locks.write(p):
+                if self.stat_token(os.stat(p)) == self.stat_token(st):
+                    os.replace(tmp, p)
+                    self.set_file_iv(file_name, iv)
+                    return True
+            # written while re-encrypting, try again
+            os.remove(tmp)
+        return False
+
+    # override
+    def file_size(self, file_name):
+        if self.fs is None:
+            return None
+        try:
+            return os.path.getsize(
+                f"{self.fs.root}/{self.fs.su.user_id}/{file_name.lstrip('/')}")
+        except OSError:
+            return None
 
     # extra functions
 
+    # re-encrypt the file at p to tmp with a new IV, then replace p
+    # returns the new IV, or None if p is not a valid encrypted file
+    # old_name: the path the file was encrypted for, with dir_keys
+    def reencrypt_file(self, su, file_name, p, tmp, replace=True,
+                       old_name=None):
+        bs = self.fs.block_size
+        with open(p, "rb") as src:
+            old_iv = src.read(bs)
+            padding_size = src.read(1)
+            if len(old_iv) != bs or len(padding_size) != 1:
+                return None
+            old_key = su.key_gen(old_iv, old_name or file_name)
+            # create a new iv => new key
+            iv = get_random_bytes(bs)
+            key = su.key_gen(iv, file_name, rotated=True)
+            with open(tmp, "wb") as dst:
+                dst.write(iv)
+                dst.write(padding_size)
+                for seg in ctr_reencrypt_stream(src, old_key, old_iv,
+                                                key, iv):
+                    dst.write(seg)
+        shutil.copystat(p, tmp)
+        if replace:
+            os.replace(tmp, p)
+            self.set_file_iv(file_name, iv)
+        return iv
+
+    def stat_token(self, st):
+        return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    # "foo.txt" and "/foo.txt" are the same file in the IVs index
+    def iv_name(self, file_name):
+        return "/" + file_name.lstrip("/")
+
+    # move the IVs of a renamed file or directory in the index
+    def rename_file_iv(self, old, new):
+        old = self.iv_name(old)
+        new = self.iv_name(new)
+        self.ivs.pop(new, None)
+        for f in list(self.ivs):
+            if f == old:
+                self.ivs[new] = self.ivs.pop(f)
+            elif f.startswith(old + "/"):
+                self.ivs[new + f[len(old):]] = self.ivs.pop(f)
+
+    # tables writers are serialized by an flock, also between processes
+    # sharing the same root, so versions can be compared then swapped
+    @contextmanager
+    def tables_lock(self):
+        with open(f"{self.tables_dir()}.lock", "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
     def tables_dir(self):
         if self.fs is None:
             return None
@@ -94,45 +256,164 @@ class FSAccessWrapper(AccessWrapper):
             os.makedirs(p)
         return p
 
+class SharedNamespace:
+    """What is visible under /shared for one generation of the tables
+    shared with us (see SharingUtility.shared_generation), so FUSE
+    operations do not go through every shared file"""
+
+    def __init__(self, generation, shared_tables):
+        self.generation = generation
+        self.sharers = set(shared_tables)
+        # sharer -> shared directories, e.g. { "docs", "a/b" }
+        self.dirs = {}
+        # sharer -> { directory -> names in it leading to shared entries }
+        self.children = {}
+        for bob, (_, table) in shared_tables.items():
+            dirs = self.dirs[bob] = set()
+            children = self.children[bob] = {}
+            for entry in table:
+                comps = path_components(entry)
+                if is_dir_entry(entry):
+                    dirs.add("/".join(comps))
+                for i in range(len(comps)):
+                    children.setdefault("/".join(comps[:i]), set()) \
+                            .add(comps[i])
+
+    def is_dir_shared(self, bob, path):
+        comps = path_components(path)
+        dirs = self.dirs.get(bob, ())
+        return any("/".join(comps[:i]) in dirs
+                   for i in range(1, len(comps) + 1))
+
+    # names of the entries of path visible to us, of the ones in names
+    def visible(self, bob, path, names):
+        if self.is_dir_shared(bob, path):
+            return list(names)
+        allowed = self.children.get(bob, {}).get(normalize_path(path), ())
+        return [n for n in names if n in allowed]
+
 class ShareFS(CryptoFS):
-    def __init__(self, root, mount, sharing_util):
+    """watch: watch the tables and our files for changes by others (see
+    watch()), instead of checking the tables on every operation"""
+
+    def __init__(self, root, mount, sharing_util, watch=False):
         super().__init__(root, mount)
         self.su = sharing_util
         self.pki = pki_interface()
         self.unlinked_ivs = {}
+        # keys of the shared files read through this mount,
+        # (sharer, path) -> (version of the sharer's table, iv, key,
+        # tables_epoch). checked against the table when the file is
+        # opened, so reads do not list and decrypt the tables again
+        self.shared_keys = {}
+        # see SharedNamespace
+        self.namespace = None
+        # with a watcher, bumped whenever a table changes. caches of an
+        # epoch that did not change are used without checking the tables
+        self.watcher = None
+        self.files_watcher = None
+        self.tables_epoch = 0
+        self.namespace_epoch = None
+        self.watch_changes = watch
         os.makedirs(f"{self.root}/{self.su.user_id}", exist_ok=True)
 
+    # the /shared namespace of the tables as they are now
+    def shared_namespace(self):
+        with self.su.lock:
+            epoch = self.tables_epoch
+            if self.is_watching() and self.namespace is not None and \
+               self.namespace_epoch == epoch:
+                return self.namespace
+            self.su.refresh_shared_index()
+            ns = self.namespace
+            if ns is None or ns.generation != self.su.shared_generation:
+                ns = SharedNamespace(self.su.shared_generation,
+                                     self.su.shared_tables)
+                self.namespace = ns
+            self.namespace_epoch = epoch
+            return ns
+
+    def watch(self, interval=1.0):
+        """Starts watching the tables and our files, with inotify or
+        by polling every interval seconds. Changes made by other
+        processes drop the cached tables and IVs. The files of the
+        sharers are not watched, the keys of shared files are cached
+        with their IVs, which change when the files are re-encrypted"""
+        aw = self.su.access_wrapper
+        tables = os.path.realpath(aw.tables_dir())
+        user_root = os.path.realpath(f"{self.root}/{self.su.user_id}")
+        def changed(paths):
+            if paths is None:
+                self.tables_changed(None)
+                aw.ivs.clear()
+                return
+            names = [os.path.basename(p) for p in paths
+                     if os.path.dirname(p) == tables]
+            if len(names) != 0:
+                self.tables_changed(names)
+            for p in paths:
+                if p.startswith(user_root + "/"):
+                    aw.drop_file_iv(os.path.relpath(p, user_root))
+        self.watcher = watch([tables], changed, interval=interval)
+        self.files_watcher = watch([user_root], changed, recursive=True,
+                                   interval=interval)
+        # anything cached so far was not watched
+        self.tables_changed(None)
+        return self.watcher
+
+    def is_watching(self):
+        return self.watcher is not None and self.watcher.is_running() and \
+            self.files_watcher.is_running()
+
+    # names: of the tables changed, None for any
+    def tables_changed(self, names):
+        self.su.forget_tables(names)
+        with self.su.lock:
+            self.tables_epoch += 1
+
+    # "/shared/bob/foo/bar.txt" -> ("bob", "foo/bar.txt")
+    def split_shared_path(self, path):
+        path = path.split("/")
+        if path[0] == "":
+            del path[0]
+        if len(path) > 2:
+            return path[1], "/".join(path[2:])
+        return None, None
+
     # override
     def key_gen(self, path, iv):
         log(f">>> key_gen({path}, {iv})")
         if path.startswith("/shared"):
             log("shared key...")
-            path = path.split("/")
-            if path[0] == "":
-                del path[0]
-            bob = path[1] if len(path) >= 2 else None
-            if len(path) > 2:
-                path = "/".join(path[2:])
-                shared = self.su.list_files_shared_with_us()
-                log(shared)
-                if "/" + path in shared[bob]:
-                    path = "/" + path
-                if bob in shared and path in shared[bob]:
-                    return shared[bob][path]
-                else:
-                    raise FuseOSError(EACCES)
+            bob, path = self.split_shared_path(path)
+            if bob is None:
+                raise FuseOSError(EACCES)
+            cached = self.shared_keys.get((bob, path))
+            cache_lookup("shared_keys", cached is not None and cached[1] == iv)
+            if cached is not None and cached[1] == iv:
+                return cached[2]
+            epoch = self.tables_epoch
+            try:
+                version = self.su.sharer_version(bob)
+            except ValueError: # not the name of a sharer
+                raise FuseOSError(ENOENT)
+            self.su.refresh_shared_index()
+            key = self.su.lookup_shared_file_key("/" + path, bob, iv) or \
+                self.su.lookup_shared_file_key(path, bob, iv)
+            if key is not None:
+                self.shared_keys[(bob, path)] = (version, iv, key, epoch)
+                return key
             else:
                 raise FuseOSError(EACCES)
         else:
             log("normal keygen...")
-            log(self.su.key_gen(iv))
-            return self.su.key_gen(iv)
+            log(self.su.key_gen(iv, path))
+            return self.su.key_gen(iv, path)
 
     # override
     def translate_path(self, path):
         ret = None
         if path.startswith("/shared"):
-            shared = self.su.list_files_shared_with_us()
             if path == "/shared":
                 ret = self.root + "/" + self.su.user_id + path
             else:
@@ -140,12 +421,17 @@ class ShareFS(CryptoFS):
                 if path[0] == "":
                     del path[0]
                 bob = path[1] if len(path) >= 2 else None
-                if len(path) == 2 and bob in shared:
+                if len(path) == 2 and bob in self.shared_namespace().sharers:
                     # paths like /shared/bob, just use root/alice/shared attrs
                     ret = f"{self.root}/{self.su.user_id}/shared"
                 elif len(path) > 2:
                     path = "/".join(path[2:])
-                    ret = f"{self.root}/{bob}/{path}"
+                    try:
+                        # groups share files of their owners
+                        owner = sharer_owner(bob)
+                    except ValueError: # not the name of a sharer
+                        raise FuseOSError(ENOENT)
+                    ret = f"{self.root}/{owner}/{path}"
                 else:
                     raise FuseOSError(EACCES)
         else:
@@ -160,31 +446,66 @@ class ShareFS(CryptoFS):
                 os.makedirs(f"{real_path}/shared")
         ret = []
         if path.startswith("/shared"):
-            shared = self.su.list_files_shared_with_us()
+            ns = self.shared_namespace()
             if path == "/shared":
-                ret = list(shared.keys())
+                ret = list(ns.sharers)
             else:
                 path = path.split("/")
                 if path[0] == "":
                     del path[0]
                 bob = path[1] if len(path) >= 2 else None
-                if len(path) >= 2:
+                if len(path) >= 2 and bob in ns.sharers:
                     path = "/".join(path[2:])
-                    other = os.listdir(f"{self.root}/{bob}/{path}")
-                    allowed = list(shared[bob].keys())
-                    allowed = list(map(lambda p: p if p[0] != '/' else p[1:],
-                                       allowed))
-                    ret = []
-                    # TODO: handle files shared in subdirectories
-                    for f in other:
-                        if f in allowed:
-                            ret.append(f)
+                    other = os.listdir(
+                        f"{self.root}/{sharer_owner(bob)}/{path}")
+                    # files shared, directories with files shared in them,
+                    # and anything in a shared directory
+                    ret = ns.visible(bob, path, other)
                 else:
                     ret = []
         else:
             ret = os.listdir(real_path)
         return ret
 
+    # override
+    def open(self, path, flags):
+        # the key of a shared file is looked up again on the first read
+        # if the sharer's table changed, e.g. the file was revoked
+        if path.startswith("/shared"):
+            bob, rel = self.split_shared_path(path)
+            cached = self.shared_keys.get((bob, rel))
+            epoch = self.tables_epoch
+            # unless no table changed since, as told by the watcher
+            if cached is not None and \
+               not (self.is_watching() and cached[3] == epoch):
+                version = self.su.sharer_version(bob)
+                # wrappers that can't tell the versions always look it up
+                if cached[0] is None or cached[0] != version:
+                    self.shared_keys.pop((bob, rel), None)
+                else:
+                    self.shared_keys[(bob, rel)] = cached[:3] + (epoch,)
+        return super().open(path, flags)
+
+    # override
+    def create(self, path, mode):
+        if not path.startswith("/shared"):
+            # the file will get a new IV on the first write
+            self.su.access_wrapper.drop_file_iv(path)
+        return super().create(path, mode)
+
+    # override
+    def write(self, path, data, offset, fh):
+        # a lazily revoked file is re-encrypted before new data
+        # is written to it
+        if not path.startswith("/shared") and self.su.is_pending(path):
+            self.su.rotate_pending([path], self.pki.get_key)
+        return super().write(path, data, offset, fh)
+
+    # override
+    def iv_changed(self, path, iv):
+        if not path.startswith("/shared"):
+            self.su.access_wrapper.set_file_iv(path, iv)
+
     # override
     def unlink(self, path):
         """Some programs (like emacs) unlink the file and create a
@@ -206,6 +527,7 @@ class ShareFS(CryptoFS):
                 return os.unlink(path)
             raise FuseOSError(EACCES)
         else:
+            self.su.access_wrapper.drop_file_iv(origin)
             return os.unlink(path)
 
     # override
@@ -233,7 +555,26 @@ class ShareFS(CryptoFS):
             shutil.copy2(old_mount, new_mount)
             return os.unlink(old_root)
         else:
-            return os.rename(old_root, new_root)
+            ret = os.rename(old_root, new_root)
+            if not old.startswith("/shared"):
+                self.su.access_wrapper.rename_file_iv(old, new)
+                if self.su.dir_keys:
+                    self.rekey_renamed(old, new, new_root)
+            return ret
+
+    def rekey_renamed(self, old, new, new_root):
+        """With dir_keys, the keys of files are of their paths. Files
+        moved are re-encrypted with the keys of their new paths"""
+        aw = self.su.access_wrapper
+        if os.path.isdir(new_root):
+            moved = [f[len(aw.iv_name(new)):] for f in aw.dir_files(new)]
+        else:
+            moved = [""]
+        for rel in moved:
+            p = new_root + rel
+            with self.locks.write(p):
+                aw.reencrypt_file(self.su, new + rel, p, f"{p}___tmp",
+                                  old_name=old + rel)
 
     # override
     def fsname(self):
@@ -242,15 +583,22 @@ class ShareFS(CryptoFS):
     # override
     def start(self):
         self.pki.init()
+        if self.watch_changes:
+            self.watch()
         return super().start()
 
-    def share(self, file_path, bob):
+    def share(self, file_paths, bob):
+        if isinstance(file_paths, str):
+            file_paths = [file_paths]
         k_bob_pub = self.pki.get_key(bob)
-        res, _, _, _ = self.su.share_file(file_path, bob, k_bob_pub)
+        res, _, _, _ = self.su.share_files(file_paths, bob, k_bob_pub)
         return res != None
 
-    def revoke(self, file_path, bob):
-        return self.su.revoke_shared_file(file_path, bob, self.pki.get_key)
+    def revoke(self, file_paths, bob):
+        if isinstance(file_paths, str):
+            file_paths = [file_paths]
+        return self.su.revoke_many([(f, bob) for f in file_paths],
+                                   self.pki.get_key)
 
     def ls_shares(self, file_path):
         res = []
@@ -292,11 +640,14 @@ class ShareFS(CryptoFS):
                 file_path = " ".join(data[2:])
 
                 if cmd == "share":
-                    ret = self.share(file_path, bob)
-                    msg += f"share({file_path}, {bob})"
+                    # many files can be shared at once, one per line
+                    file_paths = file_path.split("\n")
+                    ret = self.share(file_paths, bob)
+                    msg += f"share({file_paths}, {bob})"
                 elif cmd == "revoke":
-                    ret = self.revoke(file_path, bob)
-                    msg += f"revoke({file_path}, {bob})"
+                    file_paths = file_path.split("\n")
+                    ret = self.revoke(file_paths, bob)
+                    msg += f"revoke({file_paths}, {bob})"
                 elif cmd == "ls-shares":
                     ret = self.ls_shares(file_path)
                     msg += f"ls_shares({file_path})"
@@ -338,7 +689,7 @@ def main(args):
 
     aw = FSAccessWrapper()
     su = SharingUtility(username, password, access_wrapper=aw)
-    fs = ShareFS(args[1], args[2], su)
+    fs = ShareFS(args[1], args[2], su, watch=True)
     aw.fs = fs
     threading.Thread(target=fs.start_server).start()
     fs.start()
@@ -2,8 +2,8 @@ import socket
 
 def usage():
     print("Allowed commands:")
-    print("[PORT] share     <FILE_PATH> <USER>")
-    print("[PORT] revoke    <FILE_PATH> <USER>")
+    print("[PORT] share     <FILE_PATH>... <USER>")
+    print("[PORT] revoke    <FILE_PATH>... <USER>")
     print("[PORT] ls-shares <FILE_PATH>")
 
 def main(args):
@@ -22,13 +22,21 @@ def main(args):
             print("ERROR: no port provided")
             return
 
-    if len(args) + i not in [3, 4]:
+    if len(args) + i < 3:
         usage()
         return
 
-    cmd       = args[1 - i]
-    file_path = args[2 - i]
-    bob       = args[3 - i] if len(args) == (4 - i) else None
+    cmd = args[1 - i]
+    if cmd in ["share", "revoke"] and len(args) + i >= 4:
+        # share/revoke <FILE_PATH>... <USER>
+        file_path = "\n".join(args[2 - i:-1])
+        bob       = args[-1]
+    elif len(args) + i in [3, 4]:
+        file_path = args[2 - i]
+        bob       = args[3 - i] if len(args) == (4 - i) else None
+    else:
+        usage()
+        return
     if cmd not in ["share", "revoke", "ls-shares"]:
         usage()
         return
@@ -0,0 +1,215 @@
+"""Watches directories for changes made by other processes, with Linux
+inotify, or by polling the modification times where it is not available"""
+
+import os
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+
+# inotify(7)
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+
+IN_CHANGES = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+class Watcher:
+    """Calls callback(paths) from a background thread with the set of
+    paths changed under the watched directories, or with None if it
+    can't tell which ones (e.g. events were lost).
+
+    dirs:      directories to watch
+    callback:  function(paths)
+    recursive: watch the subdirectories too
+    """
+
+    def __init__(self, dirs, callback, recursive=False):
+        self.dirs = [os.path.realpath(d) for d in dirs]
+        self.callback = callback
+        self.recursive = recursive
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        pass
+
+    def notify(self, paths):
+        try:
+            self.callback(paths)
+        except Exception:
+            # a failing callback does not stop the watcher
+            pass
+
+class InotifyWatcher(Watcher):
+    """Watcher with inotify(7) through libc"""
+
+    # seconds between checks of stop()
+    poll_timeout = 0.5
+
+    libc = None
+
+    @classmethod
+    def load_libc(cls):
+        if cls.libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                               ctypes.c_uint32]
+            cls.libc = libc
+        return cls.libc
+
+    @classmethod
+    def available(cls):
+        try:
+            return hasattr(cls.load_libc(), "inotify_init1")
+        except (OSError, TypeError):
+            return False
+
+    def __init__(self, dirs, callback, recursive=False):
+        super().__init__(dirs, callback, recursive)
+        self.libc = self.load_libc()
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> directory
+        self.wds = {}
+        for d in self.dirs:
+            if not self.add_watch(d):
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, f"can't watch {d}")
+
+    # False if path itself can't be watched
+    def add_watch(self, path):
+        if self.recursive:
+            dirs = [p for p, _, _ in os.walk(path)] or [path]
+        else:
+            dirs = [path]
+        ok = True
+        for d in dirs:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d),
+                                             IN_CHANGES)
+            if wd >= 0:
+                self.wds[wd] = d
+            elif d == path:
+                ok = False
+        return ok
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                ready, _, _ = select.select([self.fd], [], [],
+                                            self.poll_timeout)
+                if not ready:
+                    continue
+                try:
+                    data = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                paths = self.parse(data)
+                if paths is None or len(paths) != 0:
+                    self.notify(paths)
+        finally:
+            os.close(self.fd)
+
+    # the paths changed in a buffer of events, None on overflow
+    def parse(self, data):
+        paths = set()
+        i = 0
+        while i + EVENT_HEADER.size <= len(data):
+            wd, mask, _, size = EVENT_HEADER.unpack_from(data, i)
+            i += EVENT_HEADER.size
+            name = data[i:i + size].rstrip(b"\0")
+            i += size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            d = self.wds.get(wd)
+            if mask & IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+            if d is None:
+                continue
+            path = os.path.join(d, os.fsdecode(name)) if name else d
+            paths.add(path)
+            if self.recursive and mask & IN_ISDIR and \
+               mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_watch(path)
+        return paths
+
+class PollingWatcher(Watcher):
+    """Watcher comparing the stats of the files every interval seconds"""
+
+    def __init__(self, dirs, callback, recursive=False, interval=1.0):
+        super().__init__(dirs, callback, recursive)
+        self.interval = interval
+        self.stats = self.scan()
+
+    def scan(self):
+        stats = {}
+        for d in self.dirs:
+            if self.recursive:
+                dirs = [p for p, _, _ in os.walk(d)]
+            else:
+                dirs = [d]
+            for p in dirs:
+                try:
+                    entries = list(os.scandir(p))
+                except OSError:
+                    continue
+                for e in entries:
+                    try:
+                        st = e.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    stats[e.path] = (st.st_ino, st.st_size,
+                                     st.st_mtime_ns, st.st_ctime_ns)
+        return stats
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            stats = self.scan()
+            paths = {p for p in stats.keys() | self.stats.keys()
+                     if stats.get(p) != self.stats.get(p)}
+            self.stats = stats
+            if len(paths) != 0:
+                self.notify(paths)
+
+def watch(dirs, callback, recursive=False, interval=1.0):
+    """Starts watching dirs with inotify if available,
+    polling every interval seconds otherwise"""
+    if InotifyWatcher.available():
+        try:
+            return InotifyWatcher(dirs, callback, recursive).start()
+        except OSError:
+            # e.g. out of inotify instances or watches
+            pass
+    return PollingWatcher(dirs, callback, recursive, interval).start()
@@ -66,11 +66,13 @@ class IoTDevice:
         if not self.aw.file_exists(self.file_name()):
             self.aw.upload_file(self.su, self.file_name(), b"HOLDER")
 
+        bobs = {}
         for bob in self.shared_with_list():
             if not self.su.is_shared(self.file_name(), bob):
                 self.info(f"{self.file_name()} is not shared with {bob}. Sharing...")
-                self.su.share_file(self.file_name(), bob,
-                                   self.pki.get_key(bob))
+                bobs[bob] = self.pki.get_key(bob)
+        if len(bobs) > 0:
+            self.su.share_file_with(self.file_name(), bobs)
 
     def run(self):
         """Initialize and start the device"""
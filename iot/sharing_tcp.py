@@ -1,13 +1,37 @@
 """Data access wrapper interface for sharing that uses the TCP server"""
 
-from core.sharing   import AccessWrapper, sym_enc, sym_dec, block_size
+import hashlib
+
+from core.sharing   import AccessWrapper, sym_enc, sym_dec, block_size, \
+    ctr_reencrypt_stream, ANY_VERSION, TableConflict
 from iot.tcp_client import Server
 from Crypto         import Random
 
+# a blob changed by others while updating it is
+# updated again from a fresh copy, this many times
+BLOB_CAS_ATTEMPTS = 10
+
+def table_digest(table):
+    return hashlib.sha1(table).digest()
+
+# same as Server.version()
+def blob_version(blob):
+    return None if blob is None else hashlib.sha1(blob).hexdigest()
+
 class TCPAccessWrapper(AccessWrapper):
+    # all the tables are in a single blob
+    concurrent_writes = False
+
     def __init__(self, server: Server):
+        super().__init__()
         self.server = server
         self.use_json = True
+        # tables and IVs blobs without base64, other tables in json
+        self.codec = "binary"
+        # (version, deserialized) of the last downloaded tables blob
+        self.tables_blob = (None, {})
+        # version of the IVs blob the IVs index was loaded from
+        self.ivs_version = None
 
     def storage_cost(self):
         tables = self.get_tables()
@@ -26,35 +50,106 @@ class TCPAccessWrapper(AccessWrapper):
         else:
             return tables[name]
 
-    def upload_table(self, name, table):
-        tables = self.get_tables()
-        if tables is None:
-            tables = {}
-        tables[name] = table
-        tables = self.serialize(tables)
-        return self.server.set("sharing_tables", tables)
+    def upload_table(self, name, table, expected_version=ANY_VERSION):
+        def update(tables):
+            self.check_blob_version(tables, name, expected_version)
+            tables[name] = table
+            return table_digest(table)
+        return self.update_blob("sharing_tables", update)
+
+    def append_table(self, name, data, expected_version=ANY_VERSION):
+        def update(tables):
+            self.check_blob_version(tables, name, expected_version)
+            if name not in tables:
+                return False
+            tables[name] += data
+            return table_digest(tables[name])
+        return self.update_blob("sharing_tables", update)
+
+    def table_version(self, name):
+        # the blob is downloaded only if it changed, see get_tables()
+        table = self.load_table(name)
+        if table is None:
+            return None
+        return table_digest(table)
+
+    def delete_table(self, name, expected_version=ANY_VERSION):
+        def update(tables):
+            self.check_blob_version(tables, name, expected_version)
+            if name not in tables:
+                return False
+            del tables[name]
+            return True
+        return self.update_blob("sharing_tables", update)
+
+    # IVs of files changed by other clients are only seen in the
+    # IVs blob, so the index is reloaded if the blob changed, once
+    # per tables rebuild, file_iv() only reads the index
+    def refresh_ivs(self):
+        if self.server.version("sharing_ivs") != self.ivs_version:
+            blob = self.server.get("sharing_ivs")
+            self.ivs = self.deserialize(blob) or {}
+            self.ivs_version = blob_version(blob)
 
     def load_file_iv(self, file_name):
         data = self.server.get(file_name)
         if data is None: return None
         return data[:block_size]
 
+    # IVs are not secret (they are stored with the files),
+    # so the index is kept in plain on the server
+    def set_file_iv(self, file_name, iv):
+        super().set_file_iv(file_name, iv)
+        self.update_blob("sharing_ivs",
+                         lambda ivs: ivs.__setitem__(file_name, iv))
+
     def file_exists(self, file_name):
         return self.server.exists(file_name)
 
     def reupload_file(self, su, file_name):
         data = self.server.get(file_name) # load
         if data is None: return None
-        iv = data[:block_size]
-        key = su.key_gen(iv)
-        data = sym_dec(data, key) # decrypt
-        data = sym_enc(data, key) # re-encrypt with a new iv
-        return self.server.set(file_name, data)
+        old_iv = data[:block_size]
+        old_key = su.key_gen(old_iv, file_name)
+        # create a new iv => new key
+        iv = Random.new().read(block_size)
+        key = su.key_gen(iv, file_name, rotated=True)
+        # re-encrypt the segments concurrently
+        data = ctr_reencrypt_stream(memoryview(data)[block_size:],
+                                    old_key, old_iv, key, iv)
+        ret = self.server.set(file_name, b"".join([iv, *data]))
+        self.set_file_iv(file_name, iv)
+        return ret
 
     # extras
 
+    # update(blob) modifies the deserialized blob and returns the result,
+    # the blob is written only if no one else wrote it meanwhile,
+    # otherwise it is updated again. A False result skips writing it
+    def update_blob(self, path, update):
+        for _ in range(BLOB_CAS_ATTEMPTS):
+            blob = self.server.get(path)
+            obj = self.deserialize(blob) or {}
+            ret = update(obj)
+            if ret is False or \
+               self.server.cas(path, blob, self.serialize(obj)):
+                return ret
+        raise TableConflict(path)
+
+    def check_blob_version(self, tables, name, expected_version):
+        version = table_digest(tables[name]) if name in tables else None
+        if expected_version != ANY_VERSION and version != expected_version:
+            raise TableConflict(name)
+
+    # the tables blob, downloaded again only when its version changed.
+    # the result is shared, callers must not modify it
     def get_tables(self):
-        return self.deserialize(self.server.get("sharing_tables")) or {}
+        version, tables = self.tables_blob
+        if self.server.version("sharing_tables") != version:
+            blob = self.server.get("sharing_tables")
+            tables = self.deserialize(blob) or {}
+            self.tables_blob = (blob_version(blob), tables)
+        return tables
 
     def load_file(self, su, file_name):
         data = self.server.get(file_name)
@@ -63,20 +158,27 @@ class TCPAccessWrapper(AccessWrapper):
             # First, we try to decrypt generating the key, assuming
             # that the file is ours
             iv = data[:block_size]
-            key = su.key_gen(iv)
+            key = su.key_gen(iv, file_name)
             return sym_dec(data, key)
         except ValueError: #ValueError("Padding is incorrect.")
             # If the above fails, this means that the file is not ours.
             # So we try to get the key if it is shared with us
-            key = su.get_shared_file_key(file_name)
+            key = su.get_shared_file_key(file_name, iv=iv)
             return sym_dec(data, key)
 
     def upload_file(self, su, file_name, new_data):
         data = self.server.get(file_name) # load
-        if data is None: # new file
+        # a lazily revoked file gets a new iv with its next write
+        pending = data is not None and su.is_pending(file_name)
+        if data is None or pending: # new file
             iv = Random.new().read(block_size)
         else:
             iv = data[:block_size]
-        key = su.key_gen(iv)
+        key = su.key_gen(iv, file_name)
         enc = sym_enc(new_data, key, iv) # encrypt with a new iv (or the old)
-        return self.server.set(file_name, enc)
+        ret = self.server.set(file_name, enc)
+        if data is None or pending:
+            self.set_file_iv(file_name, iv)
+        if pending:
+            su.rotate_pending([file_name], reupload=False)
+        return ret
@@ -1,6 +1,7 @@
 """TCP server interface from the client"""
 
 import socket
+import hashlib
 import time
 
 class Server:
@@ -40,6 +41,19 @@ class Server:
         s.close()
         return ack == b"t"
 
+    # set only if the data at path is still expected (None if the path
+    # should not exist), returns False if it changed meanwhile
+    def cas(self, path: str, expected: bytes, data: bytes):
+        s = self.connect()
+        # request
+        digest = "" if expected is None else hashlib.sha1(expected).hexdigest()
+        req = ("CAS?" + path + "?" + digest + "?").encode() + data + b'?END?'
+        s.send(req)
+        # acknowledge
+        ack = s.recv(10)
+        s.close()
+        return ack == b"t"
+
     def get(self, path: str):
         s = self.connect()
         # request
@@ -54,6 +68,23 @@ class Server:
         s.close()
         return data if data != b"f" else None
 
+    # sha1 hex digest of the data at path, None if it does not exist
+    def version(self, path: str):
+        s = self.connect()
+        # request
+        req = ("VER?" + path + "?END?").encode()
+        s.send(req)
+        # recieve the digest
+        data = b""
+        while 1:
+            tmp = s.recv(1024)
+            data += tmp
+            if not tmp: break
+        s.close()
+        if data == b"f":
+            raise Exception(f"Can't get the version of {path}")
+        return data.decode() or None
+
     def kill(self):
         s = self.connect()
         # request
@@ -87,7 +118,9 @@ class Server:
     def example():
         s = Server("127.0.0.1", 8080)
         #print(s.set("foo.txt", b"123 abc"))
+        #print(s.cas("foo.txt", b"123 abc", b"456 def"))
         #print(s.get("foo.txt"))
+        #print(s.version("foo.txt"))
         #print(s.exists("foo.txt"))
         #print(s.rm("foo.txt"))
         #print(s.kill())
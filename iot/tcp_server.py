@@ -2,6 +2,7 @@
 
 import socket
 import datetime
+import hashlib
 import os
 
 PORT = os.getenv("PORT") or 2010
@@ -123,6 +124,26 @@ def start_server(port, fs):
             except:
                 conn.send(b"f") # ack
                 conn.close()
+        elif cmd == b"CAS":
+            # SET only if the sha1 of the current data is the expected
+            # one (empty if it should not exist), "f" if it is not
+            try:
+                expected = data[2].decode()
+                del data[0:3] # remove cmd, path, and expected
+                del data[-1]  # remove the b"?END?"
+                del data[-1]
+                data = b"?".join(data)
+                current = hashlib.sha1(fs.get(path)).hexdigest() \
+                    if fs.exists(path) else ""
+                if current == expected:
+                    fs.set(path, data)
+                    conn.send(b"t") # ack
+                else:
+                    conn.send(b"f")
+                conn.close()
+            except:
+                conn.send(b"f") # ack
+                conn.close()
         elif cmd == b"GET":
             try:
                 conn.send(fs.get(path))
@@ -132,6 +153,19 @@ def start_server(port, fs):
                 conn.close()
                 print(f"{date()}: Error sending")
                 print(e)
+        elif cmd == b"VER":
+            # sha1 of the data, empty if it does not exist, so clients
+            # can tell if their copy is fresh without downloading it
+            try:
+                digest = hashlib.sha1(fs.get(path)).hexdigest() \
+                    if fs.exists(path) else ""
+                conn.send(digest.encode())
+                conn.close()
+            except Exception as e:
+                conn.send(b"f") # ack
+                conn.close()
+                print(f"{date()}: Error sending")
+                print(e)
         elif cmd == b"RM":
             try:
                 fs.rm(path)
@@ -1,7 +1,7 @@
 """BlockChain PKI. Intefaces with the CA"""
 
 from public_key.pki_base import PKI
-from core.sharing        import gen_keys_from, stringify_keys, PublicKey
+from core.sharing        import gen_keys_from, stringify_keys, import_key
 
 import subprocess
 import time
@@ -24,7 +24,7 @@ class BCPKI(PKI):
                 key = "-----BEGIN PUBLIC KEY-----\n" + \
                     cert["public_key"] + \
                     "\n-----END PUBLIC KEY-----"
-                return PublicKey.import_key(key)
+                return import_key(key)
         return None
 
     def list_ids(self):
@@ -1,9 +1,11 @@
 """Tests, examples, and benchmarks"""
 
+import io
 import os
 import time
 from tqdm import tqdm
 from core.sharing import *
+from core import metrics
 
 # returns a csv string with "file_size,time_to_encrypt"
 def speed_benchmark_helper(sharing):
@@ -376,12 +378,14 @@ def revocation_benchmark():
         print(f"{p} already exist")
 
 def tables_json_vs_pickle():
-    print("* Tables json vs pickle")
-
-    res = {"json": [], "pickle": []}
-    for js in [True, False]:
-        arr = res["json" if js else "pickle"]
-        aw = FakeAccessWrapper(use_json=js)
+    print("* Tables json vs pickle vs binary")
+
+    codecs = ["json", "pickle", "binary"]
+    res = {c: [] for c in codecs}
+    parse = {c: 0 for c in codecs}
+    for codec in codecs:
+        arr = res[codec]
+        aw = FakeAccessWrapper(codec=codec)
         alice = SharingUtility("alice", "abc", access_wrapper=aw)
         bob = SharingUtility(f"bob", "123", access_wrapper=aw)
 
@@ -389,17 +393,27 @@ def tables_json_vs_pickle():
             # 16 bytes = 32 bytes hex str = 256 bits file name
             f = secrets.token_bytes(16).hex()
             aw.fake_file(alice, f, size=4) # keep it tiny
-            alice.share_file(f, bob.user_id, bob.keys["pub"])
+            T_A_B, _, T_A_others, _ = \
+                alice.share_file(f, bob.user_id, bob.keys["pub"])
             arr.append(aw.storage_cost())
 
-    diffs = []
-    for i in range(len(res["json"])):
-        a, b = res['json'][i], res['pickle'][i]
-        diff = ((a - b) / ((a + b) / 2)) * 100
-        diffs.append(diff)
-        #print(f"json: {a}, pickle: {b}, diff: {diff}")
+            start = time.time()
+            aw.deserialize(T_A_B)
+            aw.deserialize(T_A_others)
+            parse[codec] += (time.time() - start) * 1000
 
-    print(sum(diffs) / len(diffs), "%")
+    for codec in ["json", "binary"]:
+        diffs = []
+        for i in range(len(res[codec])):
+            a, b = res[codec][i], res['pickle'][i]
+            diff = ((a - b) / ((a + b) / 2)) * 100
+            diffs.append(diff)
+            #print(f"{codec}: {a}, pickle: {b}, diff: {diff}")
+
+        print(f"{codec} vs pickle:", sum(diffs) / len(diffs), "%")
+
+    for codec in codecs:
+        print(f"{codec} parsing: {parse[codec]}ms")
 
 def tables_test():
     print("* Tables test")
@@ -478,6 +492,340 @@ def sharing_test():
     print(f_shared_data == f_data)
     print("** Loaded foo.txt = " + str(f_shared_data))
 
+class CountingAccessWrapper(FakeAccessWrapper):
+    """Counts the bytes of tables sent to the storage"""
+    uploaded = 0
+
+    def upload_table(self, name, table, expected_version=ANY_VERSION):
+        self.uploaded += len(table)
+        return super().upload_table(name, table, expected_version)
+
+    def append_table(self, name, data, expected_version=ANY_VERSION):
+        if name not in self.tables:
+            return False
+        self.uploaded += len(data)
+        return super().upload_table(name, self.tables[name] + data,
+                                    expected_version)
+
+def table_log_test():
+    print("* Tables log test")
+    for table_log in [False, True]:
+        aw = CountingAccessWrapper()
+        alice = SharingUtility("alice", "abc", access_wrapper=aw,
+                               table_log=table_log)
+        bob = SharingUtility("bob", "123", access_wrapper=aw)
+
+        start = time.time()
+        for N in range(100):
+            f = secrets.token_bytes(16).hex()
+            aw.fake_file(alice, f, size=4)
+            alice.share_file(f, bob.user_id, bob.keys["pub"])
+        dur = (time.time() - start) * 1000
+        uploaded = aw.uploaded
+
+        # a cold read decrypts the records with the key of the snapshot
+        session_keys_cache.clear()
+        start = time.time()
+        shared = bob.list_files_shared_with_us(only_files=True)
+        read = (time.time() - start) * 1000
+        size = len(aw.load_table(alice.get_table_name(alice_id="alice",
+                                                      bob_id="bob")))
+        print(f"table_log={table_log}: {dur}ms, {uploaded} bytes uploaded, {len(shared)} files shared with bob, read {read}ms, table {size} bytes")
+
+def shard_others_test():
+    print("* Sharded T_A_others test")
+    for shard_others in [False, True]:
+        aw = CountingAccessWrapper()
+        alice = SharingUtility("alice", "abc", access_wrapper=aw,
+                               shard_others=shard_others)
+        bob = SharingUtility("bob", "123", access_wrapper=aw)
+        f = "foo.txt"
+        aw.fake_file(alice, f, size=4)
+
+        # many recipients, same key to save time
+        for N in range(500):
+            alice.share_file(f, f"bob{N}", bob.keys["pub"])
+
+        uploaded = aw.uploaded
+        start = time.time()
+        alice.share_file(f, bob.user_id, bob.keys["pub"])
+        dur = (time.time() - start) * 1000
+        uploaded = aw.uploaded - uploaded
+
+        shared = bob.list_files_shared_with_us(only_files=True)
+        users = len(alice.list_files_shared_by_us())
+        print(f"shard_others={shard_others}: last share {dur}ms, {uploaded} bytes uploaded, {users} users, {len(shared)} files shared with bob")
+
+def groups_test():
+    print("* Group sharing test")
+    aw = CountingAccessWrapper()
+    alice = SharingUtility("alice", "abc", access_wrapper=aw)
+    # email-like ids are fine
+    bob = SharingUtility("bob@example.com", "123", access_wrapper=aw)
+    # many recipients, same key to save time
+    users = { f"bob{N}": bob.keys["pub"] for N in range(200) }
+    users[bob.user_id] = bob.keys["pub"]
+    team = alice.create_group("team", users)
+    aw.fake_file(alice, "foo.txt", size=4)
+    aw.fake_file(alice, "bar.txt", size=4)
+
+    uploaded = aw.uploaded
+    start = time.time()
+    alice.share_file_with("foo.txt", users)
+    dur = (time.time() - start) * 1000
+    print(f"to {len(users)} users: {dur}ms, {aw.uploaded - uploaded} bytes uploaded")
+
+    uploaded = aw.uploaded
+    start = time.time()
+    alice.share_file("bar.txt", team, None)
+    dur = (time.time() - start) * 1000
+    print(f"to a group of {len(users)}: {dur}ms, {aw.uploaded - uploaded} bytes uploaded")
+
+    print(bob.list_files_shared_with_us(only_files=True), bob.list_sharers())
+    alice.remove_group_members(team, [bob.user_id], users.get)
+    print(f"after removing bob: {bob.list_files_shared_with_us(only_files=True)}")
+
+    for sharer in ["alice_team", "_@team", "alice_@te_am"]:
+        try:
+            split_sharer(sharer)
+            print(f"{sharer} accepted")
+        except ValueError as e:
+            print(f"{sharer} rejected: {e}")
+
+def dir_keys_test():
+    print("* Directory sharing test")
+    aw = CountingAccessWrapper()
+    alice = SharingUtility("alice", "abc", access_wrapper=aw, dir_keys=True)
+    bob = SharingUtility("bob", "123", access_wrapper=aw)
+    carol = SharingUtility("carol", "456", access_wrapper=aw)
+    keys = { "bob": bob.keys["pub"], "carol": carol.keys["pub"] }
+    files = {}
+    for i in range(200):
+        name = f"docs/d{i % 4}/f{i}.txt"
+        files[name], _ = aw.fake_file(alice, name, size=4)
+
+    uploaded = aw.uploaded
+    alice.share_files(list(files.keys()), "carol", keys["carol"])
+    print(f"{len(files)} files: {aw.uploaded - uploaded} bytes uploaded")
+
+    uploaded = aw.uploaded
+    alice.share_file("docs/", "bob", keys["bob"])
+    print(f"their directory: {aw.uploaded - uploaded} bytes uploaded")
+
+    new_data, _ = aw.fake_file(alice, "docs/d0/new.txt", size=4)
+    ok = aw.load_fake_shared_file(bob, "docs/d0/new.txt") == new_data and \
+        all(aw.load_fake_shared_file(bob, f) == d for f, d in files.items())
+    print(f"bob reads all, new files too, ok = {ok}")
+
+    alice.revoke_shared_file("docs/", "bob", keys.get)
+    ok = bob.get_shared_file_key("docs/d0/f0.txt") is None and \
+        aw.load_fake_shared_file(carol, "docs/d0/f0.txt") == files["docs/d0/f0.txt"]
+    print(f"after revoking bob, ok = {ok}")
+
+    # the same with the async API, carol holds the directory too
+    import asyncio
+    alice.share_file("docs/", "bob", keys["bob"])
+    alice.share_file("docs/", "carol", keys["carol"])
+    old_key = bob.get_shared_file_key("docs/d1/f1.txt")
+    asyncio.run(alice.arevoke_shared_file("docs/", "bob", keys.get))
+    new_key = alice.key_gen(aw.file_iv("docs/d1/f1.txt"), "docs/d1/f1.txt")
+    ok = old_key != new_key and \
+        bob.get_shared_file_key("docs/d1/f1.txt") is None and \
+        aw.load_fake_shared_file(carol, "docs/d1/f1.txt") == files["docs/d1/f1.txt"]
+    print(f"after revoking bob asynchronously, ok = {ok}")
+
+    # a lazily revoked directory is rotated by the next write under it
+    alice.lazy_revocation = True
+    alice.share_file("docs/", "bob", keys["bob"])
+    old_key = bob.get_shared_file_key("docs/d3/f3.txt")
+    alice.revoke_shared_file("docs/", "bob", keys.get)
+    pending = alice.is_pending("/docs/d2/f2.txt")
+    files["docs/d2/f2.txt"], _ = aw.fake_file(alice, "docs/d2/f2.txt", size=4)
+    new_key = alice.key_gen(aw.file_iv("docs/d3/f3.txt"), "docs/d3/f3.txt")
+    ok = pending and old_key != new_key and \
+        len(alice.pending_files()) == 0 and \
+        bob.get_shared_file_key("docs/d3/f3.txt") is None and \
+        aw.load_fake_shared_file(carol, "docs/d2/f2.txt") == files["docs/d2/f2.txt"]
+    print(f"after writing under a lazily revoked directory, ok = {ok}")
+
+def metrics_test():
+    print("* Metrics test")
+    mem = metrics.MemorySink()
+    for enabled in [False, True]:
+        aw = FakeAccessWrapper()
+        alice = SharingUtility("alice", "abc", access_wrapper=aw)
+        bob = SharingUtility("bob", "123", access_wrapper=aw)
+        keys = { "bob": bob.keys["pub"] }
+        files = [f"f{i}.txt" for i in range(100)]
+        for f in files:
+            aw.fake_file(alice, f, size=1024)
+        if enabled:
+            metrics.enable(mem)
+
+        start = time.time()
+        alice.share_files(files, "bob", keys["bob"])
+        for f in files:
+            bob.get_shared_file_key(f)
+        alice.revoke_shared_file(files[0], "bob", keys.get)
+        dur = (time.time() - start) * 1000
+        print(f"enabled={enabled}: {dur}ms")
+    metrics.disable()
+
+    snapshot = mem.snapshot
+    for name, h in sorted(snapshot["histograms"].items()):
+        print(f"{name}: {h['count']} calls, {h['sum'] * 1000}ms")
+    for name, value in sorted(snapshot["counters"].items()):
+        print(f"{name}: {value}")
+
+def lazy_revocation_test():
+    print("* Lazy revocation test")
+    for lazy in [False, True]:
+        aw = FakeAccessWrapper()
+        alice = SharingUtility("alice", "abc", access_wrapper=aw,
+                               lazy_revocation=lazy)
+        bob = SharingUtility("bob", "123", access_wrapper=aw)
+        carol = SharingUtility("carol", "456", access_wrapper=aw)
+        keys = { "bob": bob.keys["pub"], "carol": carol.keys["pub"] }
+
+        f_data, _ = aw.fake_file(alice, "big.bin", size=16 * 1024 * 1024)
+        alice.share_file("big.bin", "bob", keys["bob"])
+        alice.share_file("big.bin", "carol", keys["carol"])
+
+        start = time.time()
+        alice.revoke_shared_file("big.bin", "bob", keys.get)
+        dur = (time.time() - start) * 1000
+
+        start = time.time()
+        left = alice.drain_pending()
+        drain = (time.time() - start) * 1000
+
+        ok = aw.load_fake_shared_file(carol, "big.bin") == f_data and \
+            bob.get_shared_file_key("big.bin") is None
+        print(f"lazy={lazy}: revoke {dur}ms, drain {drain}ms, {left} pending, ok = {ok}")
+
+def rotation_worker_test():
+    print("* Rotation worker test")
+    aw = FakeAccessWrapper()
+    alice = SharingUtility("alice", "abc", access_wrapper=aw)
+    bob = SharingUtility("bob", "123", access_wrapper=aw)
+    files = {}
+    for i in range(50):
+        files[f"f{i}"], _ = aw.fake_file(alice, f"f{i}", size=1024 * 1024)
+    alice.share_files(list(files), "bob", bob.keys["pub"])
+
+    def progress(done, total, done_bytes):
+        if done % 10 == 0:
+            print(f"{done}/{total} files, {done_bytes} bytes")
+
+    start = time.time()
+    worker = alice.rotation_worker(list(files), lambda user: bob.keys["pub"],
+                                   max_workers=4,
+                                   bytes_per_sec=20 * 1024 * 1024,
+                                   on_progress=progress)
+    worker.start()
+    worker.join()
+    dur = (time.time() - start) * 1000
+
+    ok = all(aw.load_fake_shared_file(bob, f) == files[f] for f in files)
+    print(f"rotated in {dur}ms, ok = {ok}")
+
+def async_test():
+    import asyncio
+    print("* Async sharing test")
+    aw = FakeAccessWrapper()
+    alice = SharingUtility("alice", "abc", access_wrapper=aw)
+    bobs = [SharingUtility(f"bob{i}", f"{i}", access_wrapper=aw)
+            for i in range(5)]
+    keys = { bob.user_id: bob.keys["pub"] for bob in bobs }
+    f_data, _ = aw.fake_file(alice, "foo.txt", data=b"hello")
+
+    async def run():
+        for bob in bobs:
+            await alice.ashare_file("foo.txt", bob.user_id, bob.keys["pub"])
+        print(await bobs[1].alist_files_shared_with_us(only_files=True))
+
+        # the tables of the other bobs are uploaded together
+        upload_table = aw.upload_table
+        uploads = [0, 0] # in flight, peak
+        def counted_upload(*args):
+            uploads[0] += 1
+            uploads[1] = max(uploads)
+            try:
+                return upload_table(*args)
+            finally:
+                uploads[0] -= 1
+        aw.upload_table = counted_upload
+        aw.upload_delay = 0.05
+        start = time.time()
+        await alice.arevoke_shared_file("foo.txt", "bob0", keys.get)
+        print(f"async revoke: {(time.time() - start) * 1000}ms, "
+              f"{uploads[1]} uploads at once")
+        uploads[1] = 0
+        start = time.time()
+        alice.revoke_shared_file("foo.txt", "bob1", keys.get)
+        print(f"sync revoke: {(time.time() - start) * 1000}ms, "
+              f"{uploads[1]} uploads at once")
+        aw.upload_delay = 0
+        aw.upload_table = upload_table
+
+        shared = await bobs[0].alist_files_shared_with_us(only_files=True)
+        ok = aw.load_fake_shared_file(bobs[2], "foo.txt") == f_data
+        print(f"bob0 has {shared}, bob2 ok = {ok}")
+
+        # and the tables of different sharers are loaded together
+        carols = [SharingUtility(f"carol{i}", f"c{i}", access_wrapper=aw)
+                  for i in range(2)]
+        for bob in bobs:
+            aw.fake_file(bob, f"{bob.user_id}.txt", data=b"hi")
+            for carol in carols:
+                bob.share_file(f"{bob.user_id}.txt", carol.user_id,
+                               carol.keys["pub"])
+        aw.load_delay = 0.05
+        start = time.time()
+        shared = await carols[0].alist_files_shared_with_us(only_files=True)
+        print(f"async list: {(time.time() - start) * 1000}ms, "
+              f"{len(shared)} files")
+        start = time.time()
+        shared = carols[1].list_files_shared_with_us(only_files=True)
+        print(f"sync list: {(time.time() - start) * 1000}ms, "
+              f"{len(shared)} files")
+        aw.load_delay = 0
+
+    asyncio.run(run())
+
+def cas_test():
+    import threading
+    print("* Concurrent tables writers test")
+    for table_log in [False, True]:
+        aw = FakeAccessWrapper()
+        aw.upload_delay = 0.002
+        # two devices of alice sharing at the same time
+        alice1 = SharingUtility("alice", "abc", access_wrapper=aw,
+                                table_log=table_log)
+        alice2 = SharingUtility("alice", k_sym=alice1.k_alice,
+                                k_pub=alice1.k_alice_pub,
+                                k_priv=alice1.k_alice_priv,
+                                access_wrapper=aw, table_log=table_log)
+        bob = SharingUtility("bob", "123", access_wrapper=aw)
+        files = [f"f{i}" for i in range(40)]
+        for f in files:
+            aw.fake_file(alice1, f, size=4)
+
+        def share(alice, files):
+            for f in files:
+                alice.share_file(f, "bob", bob.keys["pub"])
+        threads = [threading.Thread(target=share, args=(alice1, files[::2])),
+                   threading.Thread(target=share, args=(alice2, files[1::2]))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        others = alice1.list_files_shared_by_us()["bob"]
+        shared = bob.list_files_shared_with_us(only_files=True)
+        print(f"table_log={table_log}: T_A_others has {len(others)}, " +
+              f"T_A_B has {len(shared)} of {len(files)} files")
+
 def sym_test():
     print("* Symmetric crypto test")
     print("building keys...")
@@ -497,6 +845,18 @@ def sym_test():
     print(f"done {time.time() - t}")
     print(f"dec = {dec}")
 
+def sym_stream_test():
+    print("* Streaming symmetric crypto test")
+    keys = gen_keys_from("passs")
+    msg = secrets.token_bytes(1024 * 1024 + 5)
+    enc = sym_enc(msg, keys["sym"])
+    t = time.time()
+    dec = b"".join(sym_dec_stream(io.BytesIO(enc), keys["sym"]))
+    print(f"decrypted in {time.time() - t}, ok = {dec == msg}")
+    iv = enc[:block_size]
+    enc_stream = b"".join(sym_enc_stream(io.BytesIO(msg), keys["sym"], iv))
+    print(f"same as sym_enc = {enc_stream == enc}")
+
 def asym_test():
     print("* Asymmetric crypto test")
     print("building keys...")
@@ -516,6 +876,32 @@ def asym_test():
     print(f"done {time.time() - t}")
     print(f"dec = {dec}")
 
+def asym_modes_test():
+    print("* Asymmetric modes (RSA vs X25519) test")
+    keys = {
+        "rsa":    RSA.generate(2048),
+        "x25519": ECC.generate(curve="Curve25519")
+    }
+    msg = b"hellooooo"
+    for mode in keys:
+        key = keys[mode]
+        t = time.time()
+        enc = asym_enc(msg, key.public_key())
+        t_enc = time.time() - t
+        t = time.time()
+        dec = asym_dec(enc, key)
+        t_dec = time.time() - t
+        print(f"{mode}: size = {len(enc)}, enc = {t_enc}, dec = {t_dec}, ok = {dec == msg}")
+
+        # an unknown mode byte fails with a ValueError, like a wrong key
+        m = len(ASYM_MAGIC)
+        try:
+            asym_dec(enc[:m] + b"?" + enc[m + 1:], key)
+            ok = False
+        except ValueError:
+            ok = True
+        print(f"{mode}: unknown mode rejected, ok = {ok}")
+
 def simple_keys_test():
     keys = stringify_keys(gen_keys_from("123"))
     print(keys["pub"])
@@ -699,8 +1085,19 @@ def main(args):
     tables_json_vs_pickle()
     #tables_test()
     #sharing_test()
+    #table_log_test()
+    #shard_others_test()
+    #groups_test()
+    #dir_keys_test()
+    #sym_stream_test()
+    #lazy_revocation_test()
+    #rotation_worker_test()
+    #async_test()
+    #cas_test()
+    #metrics_test()
     #sym_test()
     #asym_test()
+    #asym_modes_test()
     #keys_test()
     #keys_caching_test()
     #pki_test()